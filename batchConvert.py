@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+# ##### BEGIN GPL LICENSE BLOCK ##### #
+# lolblender - Python addon to use League of Legends files into blender
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+
+# <pep8 compliant>
+"""Converts every .skn, .skl and .anm file under a directory without Blender.
+
+    python3 batchConvert.py [options] INPUT_DIR OUTPUT_DIR
+
+Outputs mirror the input tree: meshes as .obj and/or .skn.npz, skeletons as
+.skl.npz (names, parents and bind pose matrices, see lolPose) and
+animations as .anm.npz (frames in Blender's axes, see lolAnimation.anmClip).
+Version 4 animations get their bone names from the .skl files in their own
+and parent directory.
+
+Files are converted by a pool of worker processes, optionally each limited
+to an address space size, and reported in order.  Every result is appended
+to a journal in OUTPUT_DIR, so an interrupted run picks up where it left
+off; files that changed since are converted again.
+"""
+import contextlib
+import multiprocessing
+import os
+import struct
+import sys
+import traceback
+import numpy as np
+from io_scene_lol import lolMesh, lolSkeleton, lolAnimation, lolPose, lolCache
+
+journalName = 'batchConvert.journal'
+kinds = {'.skn': 'skn', '.skl': 'skl', '.anm': 'anm'}
+
+
+def findTasks(inputDir, outputDir, formats):
+    """Lists (relpath, kind, inputPath, outputBase, formats, sklPaths) for
+    every convertible file under inputDir, in a stable order"""
+    tasks = []
+    for root, dirs, files in os.walk(inputDir):
+        dirs.sort()
+        skeletons = []
+        if any(f.lower().endswith('.anm') for f in files):
+            #animations usually sit in an animations folder by the model
+            searchDirs = [root]
+            if os.path.normpath(root) != os.path.normpath(inputDir):
+                searchDirs.append(os.path.dirname(root))
+            skeletons = [os.path.join(d, f) for d in searchDirs
+                    for f in sorted(os.listdir(d))
+                    if os.path.splitext(f)[1].lower() == '.skl']
+        for f in sorted(files):
+            kind = kinds.get(os.path.splitext(f)[1].lower())
+            if kind is None:
+                continue
+            inputPath = os.path.join(root, f)
+            relpath = os.path.relpath(inputPath, inputDir)
+            outputBase = os.path.join(outputDir, os.path.splitext(relpath)[0])
+            tasks.append((relpath, kind, inputPath, outputBase, formats,
+                    skeletons if kind == 'anm' else []))
+    return tasks
+
+
+def fileStamp(filepath):
+    stat = os.stat(filepath)
+    return '%d:%r' % (stat.st_size, stat.st_mtime)
+
+
+def readJournal(journalPath):
+    """Returns {relpath: stamp} of the files converted successfully"""
+    done = {}
+    if not os.path.exists(journalPath):
+        return done
+    with open(journalPath) as journal:
+        for line in journal:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 3:
+                continue  # cut short by an interruption
+            relpath, stamp, status = fields[0:3]
+            if status == 'ok':
+                done[relpath] = stamp
+            else:
+                done.pop(relpath, None)
+    return done
+
+
+def convertSKN(inputPath, outputBase, formats):
+    header, materials, metaData, indices, vertices = \
+            lolMesh.importSKNArrays(inputPath)
+    outputs = []
+    if 'obj' in formats:
+        with open(outputBase + '.obj', 'w') as objFile:
+            objFile.write(lolMesh.skn2obj(header, materials, indices,
+                    vertices))
+        outputs.append(outputBase + '.obj')
+    if 'npz' in formats:
+        ranges = [[mat.startVertex, mat.numVertices, mat.startIndex,
+                mat.numIndices] for mat in materials]
+        np.savez(outputBase + '.skn.npz', version=header.version,
+                indices=np.asarray(indices, dtype=np.int32),
+                position=vertices['position'], normal=vertices['normal'],
+                texcoords=vertices['texcoords'],
+                boneIndex=vertices['boneIndex'].astype(np.uint8),
+                weights=vertices['weights'],
+                materialNames=np.array([lolMesh.sknMaterialName(mat)
+                for mat in materials], dtype=str),
+                materialRanges=np.array(ranges, dtype=np.int64).reshape(-1, 4))
+        outputs.append(outputBase + '.skn.npz')
+    return outputs
+
+
+def convertSKL(inputPath, outputBase, formats):
+    if 'npz' not in formats:
+        return []
+    header, boneList, boneIDs = lolSkeleton.importSKL(inputPath)
+    pose = lolPose.bindPose(boneList, header.version)
+    np.savez(outputBase + '.skl.npz', version=header.version,
+            names=np.array([str(bone.name) for bone in boneList], dtype=str),
+            parents=pose.parents, boneIDs=np.array(boneIDs, dtype=np.int32),
+            local=pose.local, world=pose.world,
+            inverseBind=pose.inverseBind)
+    return [outputBase + '.skl.npz']
+
+
+#Bone hashes of skeletons already read by this worker
+skeletonHashes = {}
+
+
+def convertANM(inputPath, outputBase, formats, sklPaths):
+    if 'npz' not in formats:
+        return []
+    boneHashes = {}
+    for sklPath in sklPaths:
+        if sklPath not in skeletonHashes:
+            try:
+                boneList = lolSkeleton.importSKL(sklPath)[1]
+            except (ValueError, OSError, struct.error):
+                boneList = []
+            skeletonHashes[sklPath] = lolSkeleton.boneHashDict(
+                    str(bone.name) for bone in boneList)
+        boneHashes.update(skeletonHashes[sklPath])
+    clip = lolAnimation.importANMClip(inputPath, boneHashes)
+    np.savez(outputBase + '.anm.npz', version=clip.header.version,
+            fps=clip.header.playbackFPS, data=clip.data,
+            names=np.array(clip.names, dtype=str),
+            hashes=np.array([bone.hash or 0 for bone in clip.bones],
+            dtype=np.uint32))
+    return [outputBase + '.anm.npz']
+
+
+def convertFile(task):
+    """Converts one file in a worker.  Returns relpath, stamp, status and
+    a message (the outputs, or the error).  Files the chosen formats have
+    no output for are 'skipped' rather than 'ok', so a later run with
+    other formats still converts them."""
+    relpath, kind, inputPath, outputBase, formats, sklPaths = task
+    try:
+        stamp = fileStamp(inputPath)
+        os.makedirs(os.path.dirname(outputBase) or '.', exist_ok=True)
+        #the parsers report their progress on stdout; keep it for ours
+        with open(os.devnull, 'w') as devnull:
+            with contextlib.redirect_stdout(devnull):
+                if kind == 'skn':
+                    outputs = convertSKN(inputPath, outputBase, formats)
+                elif kind == 'skl':
+                    outputs = convertSKL(inputPath, outputBase, formats)
+                else:
+                    outputs = convertANM(inputPath, outputBase, formats,
+                            sklPaths)
+        if not outputs:
+            return relpath, '-', 'skipped', 'no %s output for %s' % (
+                    kind, ','.join(formats))
+        return relpath, stamp, 'ok', ' '.join(os.path.basename(o)
+                for o in outputs)
+    except MemoryError:
+        return relpath, '-', 'failed', 'out of memory'
+    except Exception as e:
+        lines = traceback.format_exception_only(type(e), e)
+        return relpath, '-', 'failed', lines[-1].strip()
+
+
+def initWorker(maxMemory, cacheDir):
+    """Bounds the worker's address space (where supported) and enables
+    lolCache"""
+    if maxMemory:
+        try:
+            import resource
+            resource.setrlimit(resource.RLIMIT_AS, (maxMemory, maxMemory))
+        except (ImportError, ValueError, OSError) as e:
+            print("Cannot limit worker memory: %s" % e)
+    if cacheDir:
+        lolCache.configure(cacheDir)
+
+
+def batchConvert(inputDir, outputDir, formats=('obj', 'npz'), jobs=None,
+        maxMemory=None, tasksPerChild=100, resume=True, cacheDir=None):
+    """Converts everything under inputDir into outputDir.  Returns the
+    number of files that failed."""
+    os.makedirs(outputDir, exist_ok=True)
+    journalPath = os.path.join(outputDir, journalName)
+    done = readJournal(journalPath) if resume else {}
+
+    tasks = []
+    skipped = 0
+    for task in findTasks(inputDir, outputDir, formats):
+        if done.get(task[0]) == fileStamp(task[2]):
+            skipped += 1
+        else:
+            tasks.append(task)
+    print("%d files to convert, %d already done" % (len(tasks), skipped))
+
+    converted = failed = 0
+    width = len(str(len(tasks)))
+    pool = multiprocessing.Pool(jobs, initWorker, (maxMemory, cacheDir),
+            maxtasksperchild=tasksPerChild)
+    try:
+        with open(journalPath, 'a' if resume else 'w') as journal:
+            results = pool.imap(convertFile, tasks, chunksize=1)
+            for i, (relpath, stamp, status, message) in enumerate(results):
+                print("[%*d/%d] %-7s %s  %s" % (width, i + 1, len(tasks),
+                        status, relpath, message))
+                journal.write('%s\t%s\t%s\t%s\n' % (relpath, stamp, status,
+                        message))
+                journal.flush()
+                if status == 'ok':
+                    converted += 1
+                elif status == 'skipped':
+                    skipped += 1
+                else:
+                    failed += 1
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        print("Interrupted; run again to resume")
+        raise
+    finally:
+        pool.join()
+    print("%d converted, %d failed, %d skipped" % (converted, failed,
+            skipped))
+    return failed
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    parser = OptionParser(usage="%prog [options] INPUT_DIR OUTPUT_DIR")
+    parser.add_option("-f", "--formats", dest="formats",
+            help="comma separated output formats: obj, npz",
+            default="obj,npz", action="store", type="string")
+    parser.add_option("-j", "--jobs", dest="jobs", help="worker processes",
+            default=None, action="store", type="int")
+    parser.add_option("-m", "--max-memory", dest="maxMemory",
+            help="address space limit per worker in MB",
+            default=0, action="store", type="int")
+    parser.add_option("", "--tasks-per-child", dest="tasksPerChild",
+            help="files a worker converts before it is replaced",
+            default=100, action="store", type="int")
+    parser.add_option("", "--restart", dest="resume",
+            help="ignore the journal of a previous run",
+            default=True, action="store_false")
+    parser.add_option("", "--cache", dest="cacheDir",
+            help="lolCache directory for decoded files",
+            default=None, action="store", type="string")
+
+    (options, args) = parser.parse_args()
+    if len(args) != 2:
+        parser.error("expected INPUT_DIR and OUTPUT_DIR")
+    formats = [f.strip().lower() for f in options.formats.split(',')]
+    unknown = set(formats) - set(['obj', 'npz'])
+    if unknown:
+        parser.error("unknown format(s): %s" % ', '.join(sorted(unknown)))
+
+    failed = batchConvert(args[0], args[1], formats, options.jobs,
+            options.maxMemory * 1024 * 1024, options.tasksPerChild,
+            options.resume, options.cacheDir)
+    sys.exit(1 if failed else 0)
@@ -20,8 +20,11 @@
 import bpy
 from bpy import props
 from bpy_extras.io_utils import ImportHelper, ExportHelper
-from . import lolMesh, lolSkeleton, lolAnimation
+import os
+import struct
 from os import path
+# lolMesh, lolSkeleton and lolAnimation (and numpy with them) are imported
+# where they are first used, so registering the add-on stays cheap
 
 __bpydoc__="""
 Import/Export a League of Legends character model, including
@@ -58,6 +61,24 @@ class IMPORT_OT_lol(bpy.types.Operator, ImportHelper):
         box.prop(self.properties, 'DDS_FILE')
         box.prop(self.properties, 'CLEAR_SCENE', text='Clear scene before importing')
         box.prop(self.properties, 'APPLY_WEIGHTS', text='Load mesh weights')
+
+        # previews of the chosen files, from their headers alone
+        from . import lolMesh, lolSkeleton
+        skn = self.SKN_FILE and cachedProbe(lolMesh.probeSKN,
+                path.join(self.MODEL_DIR, self.SKN_FILE))
+        skl = self.SKL_FILE and cachedProbe(lolSkeleton.probeSKL,
+                path.join(self.MODEL_DIR, self.SKL_FILE))
+        if skn or skl:
+            box = layout.box()
+        if skn:
+            box.label(text='SKN v%d: %d vertices, %d faces' % (
+                    skn['version'], skn['numVertices'], skn['numFaces']))
+            for mat in skn['materials']:
+                box.label(text='    %s: %d faces' % (mat['name'],
+                        mat['numIndices'] // 3))
+        if skl:
+            box.label(text='SKL v%d: %d bones' % (skl['version'],
+                    skl['numBones']))
         
     def execute(self, context):
         
@@ -76,6 +97,7 @@ class IMPORT_OT_lolanm(bpy.types.Operator, ImportHelper):
 
     ANM_FILE = props.StringProperty(name='Animation', description='Animation .anm file')
     MODEL_DIR = props.StringProperty()
+    SIMPLIFY = props.BoolProperty(name='Simplify', description='Remove keys that interpolation reproduces', default=False)
        
     def draw(self, context):
         layout = self.layout
@@ -87,10 +109,23 @@ class IMPORT_OT_lolanm(bpy.types.Operator, ImportHelper):
             self.ANM_FILE = fileProps.filename
         box = layout.box()
         box.prop(self.properties, 'ANM_FILE')
+        box.prop(self.properties, 'SIMPLIFY', text='Simplify keyframes')
+
+        # every clip in the directory, from the headers alone
+        if self.MODEL_DIR and path.isdir(self.MODEL_DIR):
+            from . import lolAnimation
+            library = lolAnimation.getLibrary(self.MODEL_DIR)
+            box = layout.box()
+            box.label(text='Animations (%d)' % len(library.headers))
+            for name, header in library.headers.items():
+                box.label(text='%s%s: %d frames, %d fps' % (
+                        '* ' if library.isLoaded(name) else '', name,
+                        header.numFrames, header.playbackFPS))
         
     def execute(self, context):
         import_animation(MODEL_DIR=self.MODEL_DIR,
-                    ANM_FILE=self.ANM_FILE)
+                    ANM_FILE=self.ANM_FILE,
+                    SIMPLIFY=self.SIMPLIFY)
                
         return {'FINISHED'}
 
@@ -104,6 +139,8 @@ class EXPORT_OT_lol(bpy.types.Operator, ExportHelper):
     OUTPUT_FILE = props.StringProperty(name='Export File', description='File to which model will be exported')
     BASE_ON_IMPORT = props.BoolProperty(name='Base On Imported SKN', description='Base writing on an imported SKN of choice', default=True)
     INPUT_FILE = props.StringProperty(name='Import File', description='File to import certain metadata from')
+    TOLERANCE = props.FloatProperty(name='Weld Tolerance', description='Vertices whose attributes differ by less than this are merged', default=1e-5, min=0.0, precision=6)
+    OPTIMIZE = props.BoolProperty(name='Optimize For Vertex Cache', description='Reorder triangles and vertices for faster rendering', default=True)
     MODEL_DIR = props.StringProperty()
 
     filename_ext = '.skn'
@@ -121,13 +158,17 @@ class EXPORT_OT_lol(bpy.types.Operator, ExportHelper):
         box.prop(self.properties, 'OUTPUT_FILE')
         box.prop(self.properties, 'BASE_ON_IMPORT')
         box.prop(self.properties, 'INPUT_FILE')
+        box.prop(self.properties, 'TOLERANCE')
+        box.prop(self.properties, 'OPTIMIZE')
         
     def execute(self, context):
         export_char(MODEL_DIR=self.MODEL_DIR,
                 OUTPUT_FILE=self.OUTPUT_FILE,
                 INPUT_FILE=self.INPUT_FILE,
                 BASE_ON_IMPORT=self.BASE_ON_IMPORT,
-                VERSION=self.VERSION)
+                VERSION=self.VERSION,
+                TOLERANCE=self.TOLERANCE,
+                OPTIMIZE=self.OPTIMIZE)
 
         return {'FINISHED'}
         
@@ -142,6 +183,27 @@ class IMPORT_OT_sco(bpy.types.Operator, ImportHelper):
     def execute(self, context):
         import_sco(self.properties.filepath)
         return {'FINISHED'}
+#Probe results by file path, so previews drawn on every redraw only read
+#a file again when it changes
+probeCache = {}
+
+def cachedProbe(probe, filepath):
+    '''Returns probe(filepath) (e.g. lolMesh.probeSKN), or None if the file
+    is missing or unreadable'''
+    try:
+        stat = os.stat(filepath)
+    except OSError:
+        return None
+    stamp = (stat.st_mtime, stat.st_size)
+    cached = probeCache.get(filepath)
+    if cached is None or cached[0] != stamp:
+        try:
+            info = probe(filepath)
+        except (ValueError, struct.error, OSError):
+            info = None
+        cached = probeCache[filepath] = (stamp, info)
+    return cached[1]
+
 def import_char(MODEL_DIR="", SKN_FILE="", SKL_FILE="", DDS_FILE="",
         CLEAR_SCENE=True, APPLY_WEIGHTS=True, APPLY_TEXTURE=True):
     '''Import a LoL Character
@@ -154,6 +216,10 @@ def import_char(MODEL_DIR="", SKN_FILE="", SKL_FILE="", DDS_FILE="",
     APPLY_WEIGHTS:  Import bone weights from the mesh file
     APPLY_TEXTURE:  Apply the skin texture
 
+    Returns the parsed skeleton and mesh (lolSkeleton.sklAsset,
+    lolMesh.sknAsset, None for files not given); their obj attributes
+    hold the armature and mesh objects.
+
     !!IMPORTANT!!:
     If you're running this on a windows system make sure
     to escape the backslashes in the model directory you give.
@@ -161,46 +227,42 @@ def import_char(MODEL_DIR="", SKN_FILE="", SKL_FILE="", DDS_FILE="",
     BAD:  c:\\path\\to\\model
     GOOD: c:\\\\path\\\\to\\\\model
     '''
+    from . import lolMesh, lolSkeleton
 
     if CLEAR_SCENE:
         for type in ['MESH', 'ARMATURE', 'LATTICE', 'CURVE', 'SURFACE']:
             bpy.ops.object.select_by_type(extend=False, type=type)
             bpy.ops.object.delete()
 
+    # each file is parsed once; the parsed assets and the objects built
+    # from them are passed along directly
+    skl = skn = None
     if SKL_FILE:
         SKL_FILEPATH=path.join(MODEL_DIR, SKL_FILE)
-        #sklHeader, boneDict = lolSkeleton.importSKL(SKL_FILEPATH)
-        sklHeader, boneList, reorderedBoneList = lolSkeleton.importSKL(SKL_FILEPATH)
-        lolSkeleton.buildSKL(boneList, sklHeader.version)
-        armObj = bpy.data.objects['Armature']
+        skl = lolSkeleton.loadSKL(SKL_FILEPATH)
+        armObj = lolSkeleton.buildSKL(skl.boneList, skl.header.version)
         armObj.name ='lolArmature'
         armObj.data.draw_type = 'STICK'
         armObj.data.show_axes = True
         armObj.show_x_ray = True
+        skl.obj = armObj
 
     if SKN_FILE:
         SKN_FILEPATH=path.join(MODEL_DIR, SKN_FILE)
-        sknHeader, materials, metaData, indices, vertices = lolMesh.importSKN(SKN_FILEPATH)
-        lolMesh.buildMesh(SKN_FILEPATH)
-        meshObj = bpy.data.objects['lolMesh']
+        skn = lolMesh.loadSKN(SKN_FILEPATH)
+        meshObj = lolMesh.buildMesh(skn)
         bpy.ops.object.select_all(action='DESELECT')
         meshObj.select = True
         bpy.ops.transform.resize(value=(1,1,-1), constraint_axis=(False, False,
             True), constraint_orientation='GLOBAL')
-        #meshObj.name = 'lolMesh'
-        #Presently io_scene_obj.load() does not import vertex normals, 
-        #so do it ourselves
-        #for id, vtx in enumerate(meshObj.data.vertices):
-        #    vtx.normal = vertices[id]['normal']
         
-    if SKN_FILE and SKL_FILE and APPLY_WEIGHTS:
-        if reorderedBoneList == []:
-           lolMesh.addDefaultWeights(boneList, vertices, armObj, meshObj)
-        else:
+    if skn and skl and APPLY_WEIGHTS:
+        if skl.boneIDs:
            print('Using reordered Bone List')
-           lolMesh.addDefaultWeights(reorderedBoneList, vertices, armObj, meshObj)
+        lolMesh.addDefaultWeights(skl.boneList, skn.vertices, skl.obj,
+                skn.obj, skl.boneIDs)
 
-    if DDS_FILE and APPLY_TEXTURE:
+    if DDS_FILE and APPLY_TEXTURE and skn:
         DDS_FILEPATH=path.join(MODEL_DIR, DDS_FILE)
         try:  # in case user is already in object mode (ie, SKN and DDS but no SKL)
             bpy.ops.object.mode_set(mode='OBJECT')
@@ -214,34 +276,58 @@ def import_char(MODEL_DIR="", SKN_FILE="", SKL_FILE="", DDS_FILE="",
         img_name = DDS_FILE[:-4]  # remove .dds
         tex = bpy.data.textures.new(img_name + '_texImage', type='IMAGE')
         tex.image = img
-        mat = bpy.data.materials.new(name=(img_name + '_mat'))
-        mat.use_shadeless = True
 
-        mtex = mat.texture_slots.add()
-        mtex.texture = tex
-        mtex.texture_coords = 'UV'
-        mtex.use_map_color_diffuse = True
+        # texture every submesh material, or make one if the mesh has none
+        mats = [mat for mat in skn.obj.data.materials if mat is not None]
+        if not mats:
+            mats = [bpy.data.materials.new(name=(img_name + '_mat'))]
+            skn.obj.data.materials.append(mats[0])
+
+        for mat in mats:
+            mat.use_shadeless = True
 
-        meshObj.data.materials.append(mat)
+            mtex = mat.texture_slots.add()
+            mtex.texture = tex
+            mtex.texture_coords = 'UV'
+            mtex.use_map_color_diffuse = True
 
-def import_animation(MODEL_DIR="", ANM_FILE=""):
+    return skl, skn
+
+def import_animation(MODEL_DIR="", ANM_FILE="", SIMPLIFY=False,
+        ARMATURE_OBJ=None):
     '''Import an Animation for a LoL character
     MODEL_DIR:  Base directory of the animation you wish to import.
     ANM_FILE:  .anm animation file
+    SIMPLIFY:  Drop keys that interpolation reproduces
+    ARMATURE_OBJ:  Armature to animate, the active object by default
+
+    Returns the lolAnimation.anmClip that was applied.
     '''
+    from . import lolSkeleton, lolAnimation
 
     if ANM_FILE:
         ANM_FILEPATH=path.join(MODEL_DIR, ANM_FILE)
 
-    animationHeader, boneList = lolAnimation.importANM(ANM_FILEPATH)
-    lolAnimation.applyANM(animationHeader, boneList)
+    # version 4 files name bones by hash; resolve them against the armature
+    armObj = ARMATURE_OBJ if ARMATURE_OBJ is not None else bpy.context.object
+    boneHashes = lolSkeleton.boneHashDict(bone.name for bone in
+            armObj.data.bones) if armObj and armObj.type == 'ARMATURE' else {}
+    # clips already decoded this session come from the library's cache
+    clip = lolAnimation.getLibrary(path.dirname(ANM_FILEPATH)).load(
+            path.basename(ANM_FILEPATH), boneHashes)
+    lolAnimation.applyANM(clip.header, clip.bones,
+            path.splitext(ANM_FILE)[0], simplify=SIMPLIFY,
+            armatureObj=armObj)
+    return clip
     
 
 def export_char(MODEL_DIR='',
                 OUTPUT_FILE='untitled.skn',
                 INPUT_FILE='',
                 BASE_ON_IMPORT=False,
-                VERSION=2):
+                VERSION=2,
+                TOLERANCE=1e-5,
+                OPTIMIZE=True):
     '''Exports a mesh as a LoL .skn file.
 
     MODEL_DIR:      Base directory of the input and output file.
@@ -249,8 +335,11 @@ def export_char(MODEL_DIR='',
     INPUT_FILE:     Name of the file from which certain meta-data will be taken
     BASE_ON_IMPORT: Indicator on whether to take metadata from INPUT_FILE
     VERSION:        Version of the SKN we will be making
+    TOLERANCE:      Distance below which vertex attributes are welded
+    OPTIMIZE:       Reorder triangles and vertices for the vertex cache
     '''
     import bpy
+    from . import lolMesh
 
     print("model_dir:%s" % MODEL_DIR)
     
@@ -276,12 +365,13 @@ def export_char(MODEL_DIR='',
     # left over from previous export trials, probably
     # bpy.ops.transform.resize(value=(1,1,-1), constraint_axis=(False, False,
     #         True), constraint_orientation='GLOBAL')
-    lolMesh.exportSKN(meshObj, output_filepath, input_filepath, BASE_ON_IMPORT, VERSION)
+    lolMesh.exportSKN(meshObj, output_filepath, input_filepath, BASE_ON_IMPORT, VERSION,
+            TOLERANCE=TOLERANCE, OPTIMIZE=OPTIMIZE)
     # bpy.ops.transform.resize(value=(1,1,-1), constraint_axis=(False, False,
     #         True), constraint_orientation='GLOBAL')
 
 def import_sco(filepath):
-    import lolMesh
+    from . import lolMesh
     lolMesh.buildSCO(filepath)
 
 def menu_func_import(self, context):
@@ -315,22 +405,20 @@ def unregister():
 
 
 def test_anm():
+    from . import lolSkeleton, lolAnimation
     base_dir = "C:\\Users\\Tath\\Downloads\\New folder\\DATA\\Characters\\Annie\\"
     skn = "Annie.skn"
     skl = "Annie.skl"
     anm_dir = base_dir + "animations\\"
     anm = "annie_channel.anm"
 
-    skn_path = base_dir + skn
-    skl_path = base_dir + skl
-    anm_path = anm_dir + anm
-
-    skl_header, skl_bone_list, reordered_bone_list = lolSkeleton.importSKL(skl_path)
-    anm_header, anm_bone_list = lolAnimation.importANM(anm_path)
-
-    import_char(MODEL_DIR=base_dir, SKN_FILE=skn, SKL_FILE=skl, DDS_FILE="",
-            CLEAR_SCENE=True, APPLY_WEIGHTS=True, APPLY_TEXTURE=False)
-    import_animation(MODEL_DIR=anm_dir, ANM_FILE=anm)
+    skl_asset, skn_asset = import_char(MODEL_DIR=base_dir, SKN_FILE=skn,
+            SKL_FILE=skl, DDS_FILE="", CLEAR_SCENE=True, APPLY_WEIGHTS=True,
+            APPLY_TEXTURE=False)
+    clip = import_animation(MODEL_DIR=anm_dir, ANM_FILE=anm,
+            ARMATURE_OBJ=skl_asset.obj)
+    skl_bone_list = skl_asset.boneList
+    anm_header, anm_bone_list = clip.header, clip.bones
 
     boneCheckList = ['r_hand']
     for bone in skl_bone_list:
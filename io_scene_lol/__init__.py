@@ -18,7 +18,8 @@
 # <pep8 compliant>
 
 __in_blender__ = False
-__all__ = ['lolMesh', 'lolSkeleton', '__bpy_init__']
+__all__ = ['lolMesh', 'lolSkeleton', 'lolAnimation', 'lolMath', 'lolPose',
+        'lolCache', '__bpy_init__']
 
 bl_info = {
     'name': 'Import League of Legends Character files (.skn;.skl)',
@@ -32,17 +33,59 @@ bl_info = {
     'tracker_url':'https://github.com/lispascal/lolblender/issues'
     }
 
-#Try importing blender API - will fail if running outside of blender
+#The file parsers (lolMesh, lolSkeleton, lolAnimation) and lolMath / lolPose
+#only need numpy; bpy is imported inside the functions that build Blender
+#data, so they work outside of Blender as well.
+
+#Only check for the blender API here.  __bpy_init__ (operators, menus) is
+#imported when Blender registers the add-on, and it imports the parsers
+#when an operator first runs, so enabling the add-on costs next to nothing.
 try:
-    #Attempt to load everything from __bpy_init__ into the current namespace
-    from .__bpy_init__ import *
+    import bpy
     #if this was successful, we're within Blender.  Set the flag True
     __in_blender__ = True
 except ImportError:
-    #Don't exit if we couldn't import bpy related modules, we may be getting
-    #called for something else...
+    #Don't exit if we couldn't import bpy, we may be getting called for
+    #something else...
     pass
 
+
+def register():
+    from . import __bpy_init__
+    __bpy_init__.register()
+
+
+def unregister():
+    from . import __bpy_init__
+    __bpy_init__.unregister()
+
+
+#import_char, export_char etc. used to be re-exported from __bpy_init__.
+#These wrappers keep them available without importing it up front.
+def import_char(*args, **kwargs):
+    from . import __bpy_init__
+    return __bpy_init__.import_char(*args, **kwargs)
+
+
+def import_animation(*args, **kwargs):
+    from . import __bpy_init__
+    return __bpy_init__.import_animation(*args, **kwargs)
+
+
+def export_char(*args, **kwargs):
+    from . import __bpy_init__
+    return __bpy_init__.export_char(*args, **kwargs)
+
+
+def import_sco(*args, **kwargs):
+    from . import __bpy_init__
+    return __bpy_init__.import_sco(*args, **kwargs)
+
+
+def test_anm(*args, **kwargs):
+    from . import __bpy_init__
+    return __bpy_init__.test_anm(*args, **kwargs)
+
 if __name__ == "__main__":
     #If we're inside blender, register the plugin
     if __in_blender__:
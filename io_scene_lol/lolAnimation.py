@@ -25,8 +25,12 @@
 # and this file makes use of that work
 
 # <pep8 compliant>
+import collections
+import os
 import struct
-import mathutils
+import zlib
+import numpy as np
+from . import lolCache, lolMath
 
 class anmHeader():
     """LoL animation header format:
@@ -91,20 +95,22 @@ class anmHeader():
         self.numFrames = None
         self.playbackFPS = None
 
-    def fromFile(self, anmFile):
+    def fromFile(self, anmFile, verbose=True):
         """Reads the skl header object from the raw binary file"""
         anmFile.seek(0)
         beginning = struct.unpack(self.__format__i, anmFile.read(self.__size__i))
         (self.id, self.version) = beginning
 
-        print("ANM Version: %d" % self.version)
+        if verbose:
+            print("ANM Version: %d" % self.version)
         if self.version in [0, 2, 3]:  # versions 0-3
             rest = struct.unpack(self.__format__v023, anmFile.read(self.__size__v023))
             (self.magic, self.numBones, self.numFrames, self.playbackFPS) = rest
-            print("anmMagic: %s" % self.magic)
-            print("anmNumBones: %s" % self.numBones)
-            print("anmnumFrames: %s" % self.numFrames)
-            print("anmplaybackFPS: %s" % self.playbackFPS)
+            if verbose:
+                print("anmMagic: %s" % self.magic)
+                print("anmNumBones: %s" % self.numBones)
+                print("anmnumFrames: %s" % self.numFrames)
+                print("anmplaybackFPS: %s" % self.playbackFPS)
         elif self.version == 1:  # version 1
             rest = struct.unpack(self.__format__v1, anmFile.read(self.__size__v1))
             (self.magic, self.numBones, self.offset, self.numFrames, 
@@ -129,8 +135,9 @@ class anmHeader():
             self.offsets2 = rest[13:16]
         else:
             raise ValueError("Version %s ANM not supported" % self.version)
-        print("Version: %s" % self.version)
-        print("magic: %s" % self.magic)
+        if verbose:
+            print("Version: %s" % self.version)
+            print("magic: %s" % self.magic)
     
     def toFile(self, anmFile):
         """Writes the header object to a raw binary file"""
@@ -139,6 +146,78 @@ class anmHeader():
         anmFile.write(data)
 
 
+#Frame records in the file are orientation x, y, z, w then position x, y, z
+#in the game's axes.  Clips keep them as orientation w, x, y, z then
+#position x, y, z in Blender's axes, which mirrors z.
+blenderFrameOrder = [3, 0, 1, 2, 4, 5, 6]
+blenderFrameSigns = np.array([-1, 1, 1, -1, 1, 1, -1], dtype=np.float32)
+
+
+def framesToBlender(records):
+    """Converts file frame records (last axis 7) to Blender's layout"""
+    return np.ascontiguousarray(records[..., blenderFrameOrder] *
+            blenderFrameSigns, dtype=np.float32)
+
+
+def framesFromBlender(frames):
+    """Inverse of framesToBlender"""
+    records = np.empty_like(frames)
+    records[..., blenderFrameOrder] = frames * blenderFrameSigns
+    return records
+
+
+#v4 frame record: bone name hash and indices into the shared position
+#(vector) and orientation pools
+anmFrameV4Dtype = np.dtype([('hash', '<u4'), ('positionId', '<u2'),
+        ('scaleId', '<u2'), ('orientationId', '<u2'), ('padding', '<u2')])
+
+
+def readFramesV4(anmFile, header):
+    """Decodes the frame data of a version 4 file in bulk.
+
+    The offsets in the header count from the end of the id/version block
+    (byte 12).  Returns the bone hashes, in order of first appearance, and a
+    (numFrames, numBones, 7) float32 array of frame records laid out like the
+    v0-3 ones: orientation x, y, z, w then position x, y, z.
+    """
+    numBones = header.numBones
+    numFrames = header.numFrames
+    numPositions = (header.orientationOffset - header.positionOffset) // 12
+    numOrientations = (header.indexOffset - header.orientationOffset) // 16
+
+    anmFile.seek(12 + header.positionOffset)
+    positions = np.frombuffer(anmFile.read(12 * numPositions),
+            '<f4').reshape(-1, 3)
+    anmFile.seek(12 + header.orientationOffset)
+    orientations = np.frombuffer(anmFile.read(16 * numOrientations),
+            '<f4').reshape(-1, 4)
+    anmFile.seek(12 + header.indexOffset)
+    records = np.frombuffer(anmFile.read(anmFrameV4Dtype.itemsize *
+            numBones * numFrames), anmFrameV4Dtype)
+    if len(records) != numBones * numFrames:
+        raise ValueError("Unexpected end of file in v4 frame data")
+
+    #Number the bones by first appearance; a stable sort by bone then keeps
+    #each bone's records in frame order
+    hashes, first, boneIds = np.unique(records['hash'], return_index=True,
+            return_inverse=True)
+    if len(hashes) != numBones or np.any(np.bincount(boneIds.ravel()) !=
+            numFrames):
+        raise ValueError("v4 frame data does not hold %d frames of %d bones"
+                % (numFrames, numBones))
+    order = np.argsort(first, kind='mergesort')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(numBones)
+    boneIds = rank[boneIds.ravel()]
+    records = records[np.argsort(boneIds, kind='mergesort')]
+    records = records.reshape(numBones, numFrames).T
+
+    frames = np.empty((numFrames, numBones, 7), dtype=np.float32)
+    frames[..., 0:4] = orientations[records['orientationId']]
+    frames[..., 4:7] = positions[records['positionId']]
+    return hashes[order], frames
+
+
 class anmBone():
     """LoL Bone structure format
     v0,2-3
@@ -161,8 +240,10 @@ class anmBone():
         self.__size__f = struct.calcsize(self.__format__f)
         self.name = None
         self.parent = None
-        self.orientations = []
-        self.positions = []
+        self.hash = None
+        self.unknown = 0
+        #numFrames x 7 (see framesToBlender), usually a view into an anmClip
+        self.frames = np.zeros((0, 7), dtype=np.float32)
 
 
     def metaDataFromFile(self, anmFile, version):
@@ -186,42 +267,115 @@ class anmBone():
         else:
             raise ValueError("Unhandled Bone version number", version)
 
-    def frameDataFromFile(self, anmFile, version):
-        """Reads animation bone frame data from a binary file fid"""
+    def frameDataFromFile(self, anmFile, version, records):
+        """Reads the bone's whole frame block from a binary file fid, with
+        one read, into records (a numFrames x 7 float32 array) as stored in
+        the file"""
         if version in [0,2,3]:
-            fields = struct.unpack(self.__format__f,
-                    anmFile.read(self.__size__f))
-            orientation = mathutils.Quaternion([-fields[3], fields[0],
-                    fields[1], -fields[2]])
-            # orientation = mathutils.Quaternion(fields[0:4])
-            position = mathutils.Vector(fields[4:7])
-            position.z *= -1
-            self.add_frame(position, orientation)
+            if anmFile.readinto(records) != records.nbytes:
+                raise ValueError("Unexpected end of file in frame data")
         else:
             raise ValueError("Unhandled Bone version number", version)
 
-    def add_frame(self, position, orientation):
-        """Adds a position Vector and orientation Quaternion to this bone's
-        lists, representing a new frame."""
-        self.positions.append(position)
-        self.orientations.append(orientation)
+    @property
+    def orientations(self):
+        """numFrames x 4 view of the orientation quaternions (w, x, y, z)"""
+        return self.frames[:, 0:4]
+
+    @property
+    def positions(self):
+        """numFrames x 3 view of the positions"""
+        return self.frames[:, 4:7]
 
     def get_frame(self, frame_number):
-        """Returns the position Vector and orientation Quaternion of a bone
-        in a given frame."""
+        """Returns views of the position and orientation quaternion of a
+        bone in a given frame."""
         return self.positions[frame_number], self.orientations[frame_number]
 
     def toFile(self, anmFile, version):
         """Writes animation bone object to a binary file FID"""
         if version in [0,1,2,3]:
-            data = struct.pack(self.__format__i, self.name, self.unknown)
-            for j in range(0, len(self.orientations)):
-                data += struct.pack(self.__format__f, self.orientations[j],
-                        self.positions[j])
+            data = struct.pack(self.__format__i, self.name.encode(),
+                    self.unknown)
+            data += framesFromBlender(self.frames).astype('<f4').tobytes()
             anmFile.write(data)
 
 
-def importANM(filepath):
+class anmClip():
+    """An animation held in one contiguous float32 array.
+
+    data has shape (numBones, numFrames, 7), each record being orientation
+    w, x, y, z then position x, y, z in Blender's axes.  bones are anmBones
+    whose frames are views into data, and every per-bone or per-frame
+    slice below is a view as well.  Nothing here depends on Blender.
+    """
+
+    def __init__(self, header, bones, data):
+        self.header = header
+        self.bones = bones
+        self.data = data
+        for bone, frames in zip(bones, data):
+            bone.frames = frames
+
+    @property
+    def numBones(self):
+        return self.data.shape[0]
+
+    @property
+    def numFrames(self):
+        return self.data.shape[1]
+
+    @property
+    def names(self):
+        return [bone.name for bone in self.bones]
+
+    @property
+    def orientations(self):
+        """numBones x numFrames x 4 view"""
+        return self.data[..., 0:4]
+
+    @property
+    def positions(self):
+        """numBones x numFrames x 3 view"""
+        return self.data[..., 4:7]
+
+    def get_frame(self, frame_number):
+        """numBones x 7 view of one frame"""
+        return self.data[:, frame_number]
+
+    def bone(self, name):
+        """Returns the anmBone called name, or None"""
+        for bone in self.bones:
+            if bone.name == name:
+                return bone
+        return None
+
+
+#Bump when importANMClip's results change, to invalidate lolCache entries
+anmCacheVersion = 1
+
+
+def importANMClip(filepath, boneHashes=None):
+    """Reads a .anm file into an anmClip.
+    Version 4 files identify bones by name hash; boneHashes (see
+    lolSkeleton.boneHashDict) maps those back to names.  Unresolved bones
+    are named after their hash.  With lolCache enabled, unchanged files
+    come back with their frames mapped read only from the cache."""
+    if boneHashes is None:
+        boneHashes = {}
+    key, cached = lolCache.lookup('anm', filepath, anmCacheVersion)
+    if cached is not None:
+        print("Reading ANM from cache: %s" % filepath)
+        meta, arrays = cached
+        header = lolCache.decodeState(meta['header'], anmHeader())
+        boneList = []
+        for state in meta['bones']:
+            boneList.append(lolCache.decodeState(state, anmBone()))
+            if header.version == 4:
+                boneList[-1].name = boneHashes.get(boneList[-1].hash,
+                        '%08x' % boneList[-1].hash)
+        return anmClip(header, boneList, arrays['data'])
+
     header = anmHeader()
     boneList= []
     
@@ -231,120 +385,420 @@ def importANM(filepath):
     #Read the file header to get # of bones
     header.fromFile(anmFid)
     if header.version in [0, 1, 2, 3]:
-        #Read in the bones
+        #Read in the bones, each bone's frames with a single read
+        records = np.empty((header.numBones, header.numFrames, 7),
+                dtype='<f4')
         for i in range(header.numBones):
             boneList.append(anmBone())
             boneList[i].metaDataFromFile(anmFid, header.version)
-            # print("bone %s: %s" % (i, boneList[i].name))
-            for j in range(header.numFrames):
-                # print(j)
-                boneList[i].frameDataFromFile(anmFid, header.version)
-            # print("p:%s\no:%s" % (boneList[i].positions[0],
-            #             boneList[i].orientations[0]))
+            boneList[i].frameDataFromFile(anmFid, header.version, records[i])
 
     elif header.version == 4:
-        print("not supported yet")
+        hashes, frames = readFramesV4(anmFid, header)
+        records = np.ascontiguousarray(frames.swapaxes(0, 1))
+        for i, boneHash in enumerate(hashes.tolist()):
+            boneList.append(anmBone())
+            boneList[i].hash = boneHash
+            boneList[i].name = boneHashes.get(boneHash, '%08x' % boneHash)
     else:
         raise ValueError("ANM File Version not supported.", header.version)
 
 
     anmFid.close()
-    return header, boneList
+    clip = anmClip(header, boneList, framesToBlender(records))
+    lolCache.store(key, {'header': lolCache.encodeState(header),
+            'bones': [dict((name, getattr(bone, name)) for name in
+            ['name', 'hash', 'unknown']) for bone in boneList]},
+            {'data': clip.data})
+    return clip
+
+
+def importANM(filepath, boneHashes=None):
+    """Reads a .anm file into its header and a list of anmBones.
+    See importANMClip."""
+    clip = importANMClip(filepath, boneHashes)
+    return clip.header, clip.bones
 
 
-def applyANM(header, boneList):
+def readANMHeader(filepath):
+    """Reads only the anmHeader of a .anm file"""
+    header = anmHeader()
+    with open(filepath, 'rb') as anmFid:
+        header.fromFile(anmFid, verbose=False)
+    return header
+
+
+def probeANM(filepath):
+    """Describes a .anm file from its header alone, without reading the
+    frames.  Returns a dictionary of version, counts, playback rate and the
+    byte offsets of the frame data."""
+    with open(filepath, 'rb') as anmFid:
+        header = anmHeader()
+        header.fromFile(anmFid, verbose=False)
+        dataOffset = anmFid.tell()
+        anmFid.seek(0, os.SEEK_END)
+        fileSize = anmFid.tell()
+    info = {
+        'type': 'anm',
+        'version': header.version,
+        'magic': header.magic,
+        'numBones': header.numBones,
+        'numFrames': header.numFrames,
+        'playbackFPS': header.playbackFPS,
+        'duration': (header.numFrames / float(header.playbackFPS)
+                if header.playbackFPS else 0.0),
+        'fileSize': fileSize,
+        }
+    if header.version == 4:
+        #offsets in the header count from byte 12, see readFramesV4
+        info['positionOffset'] = 12 + header.positionOffset
+        info['orientationOffset'] = 12 + header.orientationOffset
+        info['frameOffset'] = 12 + header.indexOffset
+        info['numPositions'] = (header.orientationOffset -
+                header.positionOffset) // 12
+        info['numOrientations'] = (header.indexOffset -
+                header.orientationOffset) // 16
+    else:
+        #bones follow the header, each a 36 byte name block and its frames
+        info['boneOffset'] = dataOffset
+        info['boneSize'] = 36 + 28 * header.numFrames
+    return info
+
+
+class anmLibrary():
+    """The animations of a model directory.
+
+    scan() reads just the header of every .anm file, so clips can be listed
+    (clipNames, headers) without touching their frame data.  load() decodes
+    a clip on first use and keeps it in a least recently used cache bounded
+    by maxBytes of frame data; the most recent clip is always kept however
+    large it is.  Files that changed on disk since they were scanned or
+    loaded are read again.  scanTime is the directory's modification time
+    as of the last scan.
+    """
+
+    def __init__(self, directory, maxBytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.headers = collections.OrderedDict()
+        self.errors = {}
+        self.cacheBytes = 0
+        self.scanTime = None
+        self.__stamps = {}
+        self.__cache = collections.OrderedDict()
+
+    def __stamp(self, name):
+        stat = os.stat(os.path.join(self.directory, name))
+        return (stat.st_mtime, stat.st_size)
+
+    def scan(self):
+        """Reads the header of every .anm file in the directory, skipping
+        files whose header was already read and has not changed since."""
+        headers = collections.OrderedDict()
+        self.errors = {}
+        #taken before listing, so files added meanwhile trigger a rescan
+        self.scanTime = os.stat(self.directory).st_mtime
+        names = sorted(f for f in os.listdir(self.directory)
+                if os.path.splitext(f)[1].lower() == '.anm')
+        for name in names:
+            stamp = self.__stamp(name)
+            if name in self.headers and self.__stamps.get(name) == stamp:
+                headers[name] = self.headers[name]
+                continue
+            try:
+                headers[name] = readANMHeader(os.path.join(self.directory,
+                        name))
+            except (ValueError, struct.error) as e:
+                print("Skipping %s: %s" % (name, e))
+                self.errors[name] = e
+                continue
+            self.__stamps[name] = stamp
+            self.evict(name)
+        self.headers = headers
+        return headers
+
+    @property
+    def clipNames(self):
+        return list(self.headers.keys())
+
+    def isLoaded(self, name):
+        return name in self.__cache
+
+    def evict(self, name=None):
+        """Drops one clip, or every clip, from the cache"""
+        names = [name] if name is not None else list(self.__cache.keys())
+        for n in names:
+            clip = self.__cache.pop(n, None)
+            if clip is not None:
+                self.cacheBytes -= clip.data.nbytes
+
+    def load(self, name, boneHashes=None):
+        """Returns the anmClip for file name, decoding it only if it is not
+        cached.  boneHashes resolves version 4 bone names as in
+        importANMClip."""
+        filepath = os.path.join(self.directory, name)
+        stamp = self.__stamp(name)
+        clip = self.__cache.get(name)
+        if clip is not None and self.__stamps.get(name) == stamp:
+            self.__cache.move_to_end(name)
+            if boneHashes and clip.header.version == 4:
+                for bone in clip.bones:
+                    bone.name = boneHashes.get(bone.hash, bone.name)
+            return clip
+
+        self.evict(name)
+        clip = importANMClip(filepath, boneHashes)
+        self.__stamps[name] = stamp
+        self.headers[name] = clip.header
+        self.__cache[name] = clip
+        self.cacheBytes += clip.data.nbytes
+        while self.cacheBytes > self.maxBytes and len(self.__cache) > 1:
+            oldest = next(iter(self.__cache))
+            self.evict(oldest)
+        return clip
+
+
+#Libraries by directory, kept for the whole session
+anmLibraries = {}
+
+
+def getLibrary(directory):
+    """Returns the session's anmLibrary for directory, scanning it on first
+    use and again whenever files were added, removed or renamed since"""
+    directory = os.path.abspath(directory)
+    library = anmLibraries.get(directory)
+    if library is None:
+        library = anmLibrary(directory)
+        anmLibraries[directory] = library
+    if library.scanTime != os.stat(directory).st_mtime:
+        library.scan()
+    return library
+
+
+def locationError(interp, values):
+    """Distance between interpolated and actual locations"""
+    return np.sqrt(np.sum((interp - values) ** 2, axis=-1))
+
+
+def rotationError(interp, values):
+    """Angle between interpolated and actual rotations.  Blender
+    interpolates quaternion channels linearly and normalizes, so do the
+    same here."""
+    norm = np.sqrt(np.sum(interp ** 2, axis=-1))
+    dots = np.abs(np.sum(interp * values, axis=-1)) / np.maximum(norm, 1e-12)
+    return 2 * np.arccos(np.clip(dots, 0.0, 1.0))
+
+
+def keyMask(values, errorFunc, tolerance, maxSpan=64):
+    """Chooses which keys of sampled channels to keep.
+
+    values is frames x bones x channels.  Working through the frames for
+    all bones at once, each bone's current segment is extended while
+    linear interpolation from its last kept key reproduces every frame in
+    between within tolerance (as measured by errorFunc); otherwise the
+    previous frame becomes a key.  Returns a frames x bones boolean mask.
+    Bones that never leave tolerance of their first frame keep only it
+    and are left out of the search.  Segments are cut after maxSpan
+    frames, so each step checks at most maxSpan frames per bone.
+    """
+    numFrames, numBones = values.shape[:2]
+    keep = np.zeros((numFrames, numBones), dtype=bool)
+    if numFrames == 0:
+        return keep
+    keep[0] = True
+    keep[-1] = True
+    constant = np.all(errorFunc(values[:1], values) <= tolerance, axis=0)
+    keep[1:, constant] = False
+
+    active = np.flatnonzero(~constant)
+    if len(active) == 0:
+        return keep
+    values = values[:, active]
+    bones = np.arange(len(active))
+    anchor = np.zeros(len(active), dtype=np.intp)
+    for end in range(2, numFrames):
+        failed = end - anchor > maxSpan
+        first = int(np.maximum(anchor, end - 1 - maxSpan).min())
+        t = np.arange(first, end)[:, None]
+        start = values[anchor, bones]
+        alpha = (t - anchor) / (end - anchor).astype(np.float64)
+        interp = start + alpha[..., None] * (values[end] - start)
+        inside = t > anchor
+        err = errorFunc(interp, values[first:end])
+        failed |= np.any(inside & (err > tolerance), axis=0)
+        keep[end - 1, active[failed]] = True
+        anchor[failed] = end - 1
+    return keep
+
+
+def reduceKeys(locations, rotations, locationTolerance=1e-3,
+        angleTolerance=1e-3):
+    """Keyframe reduction for pose tracks (frames x bones x 3 / x 4).
+
+    Returns keep masks (frames x bones) for the location and rotation keys,
+    see keyMask.  A channel that stays at its rest value (zero location,
+    identity rotation) for the whole clip gets no keys at all.
+    """
+    keepLocations = keyMask(locations, locationError, locationTolerance)
+    keepRotations = keyMask(rotations, rotationError, angleTolerance)
+
+    identity = np.array([1.0, 0.0, 0.0, 0.0])
+    atRest = np.all(locationError(np.zeros(3), locations) <=
+            locationTolerance, axis=0)
+    keepLocations[:, atRest] = False
+    atRest = np.all(rotationError(identity, rotations) <= angleTolerance,
+            axis=0)
+    keepRotations[:, atRest] = False
+    return keepLocations, keepRotations
+
+
+def addBoneFCurves(action, boneName, dataPath, frames, values,
+        interpolation=None):
+    """Creates one F-curve per column of values (numKeys x numChannels) for
+    a pose bone property, keyed at frames, filling every key in bulk."""
+    if len(frames) == 0:
+        return
+    path = 'pose.bones["%s"].%s' % (boneName, dataPath)
+    co = np.empty((len(frames), 2), dtype=np.float32)
+    co[:, 0] = frames
+    for channel in range(values.shape[1]):
+        fcurve = action.fcurves.new(path, index=channel,
+                action_group=boneName)
+        fcurve.keyframe_points.add(len(frames))
+        co[:, 1] = values[:, channel]
+        fcurve.keyframe_points.foreach_set('co', co.ravel())
+        if interpolation is not None:
+            setInterpolation(fcurve.keyframe_points, interpolation)
+        fcurve.update()
+
+
+def setInterpolation(points, interpolation):
+    """Sets the interpolation of all keyframe points of a curve in one
+    foreach_set call.  Blender versions whose foreach_set rejects enum
+    properties get one assignment per point instead."""
+    items = points[0].bl_rna.properties['interpolation'].enum_items
+    try:
+        points.foreach_set('interpolation',
+                [items[interpolation].value] * len(points))
+    except (TypeError, RuntimeError):
+        for point in points:
+            point.interpolation = interpolation
+
+
+def restPoseArrays(ob):
+    """Returns a {bone name: row} dictionary with the rest rotations
+    (w, x, y, z) and armature-space head positions of ob's bones as arrays.
+
+    The arrays are computed once and cached on the armature object as the
+    'lolRestPose' property, keyed by a CRC of the bone names and rest
+    matrices, so renaming or editing bones rebuilds it.
+    """
+    bones = ob.data.bones
+    names = [b.name for b in bones]
+    matrices = np.empty(len(bones) * 16, dtype=np.float32)
+    bones.foreach_get('matrix_local', matrices)
+    key = zlib.crc32('\0'.join(names).encode())
+    key = zlib.crc32(matrices.tobytes(), key)
+    #ID properties hold signed 32 bit ints, so keep the key below 2**31
+    key &= 0x7fffffff
+
+    cache = ob.get('lolRestPose')
+    if cache is None or cache['key'] != key:
+        rot = [b.matrix_local.decompose()[1][:] for b in bones]
+        head = [b.head_local[:] for b in bones]
+        ob['lolRestPose'] = {'key': key,
+                'rot': np.ravel(rot).tolist(),
+                'head': np.ravel(head).tolist()}
+        cache = ob['lolRestPose']
+
+    rows = dict((name, i) for i, name in enumerate(names))
+    rot = np.array(cache['rot'][:], dtype=np.float64).reshape(-1, 4)
+    head = np.array(cache['head'][:], dtype=np.float64).reshape(-1, 3)
+    return rows, rot, head
+
+
+def poseTracks(positions, orientations, restRot, restHead):
+    """Converts animation tracks to pose bone channels for a whole clip.
+
+    positions (frames x bones x 3) and orientations (frames x bones x 4,
+    w x y z) are armature-space bone transforms; restRot and restHead
+    (bones x 4 / bones x 3) the matching bones' rest pose.  Returns
+    locations (the offset from the rest head in bone space) and
+    rotations (rot^-1 * orientation * rot), continuous in sign over frames.
+    """
+    restRotInv = lolMath.quatConjugate(restRot)
+    locations = lolMath.quatRotate(restRotInv, positions - restHead)
+    rotations = lolMath.quatMultiply(lolMath.quatMultiply(restRotInv,
+            orientations), restRot)
+    return locations, lolMath.quatMakeContinuous(rotations, axis=0)
+
+
+def applyANM(header, boneList, actionName='lolAnimation', simplify=False,
+        locationTolerance=1e-3, angleTolerance=1e-3, armatureObj=None):
+    """Builds an action on armatureObj (default: the active object) from
+    imported animation bones.  Pose-space locations and rotations for every frame are computed
+    up front in one vectorized pass, then each F-curve is created once and
+    filled in bulk; the scene frame is never changed.
+
+    With simplify, keys that linear interpolation reproduces within
+    locationTolerance / angleTolerance (radians) are dropped, see
+    reduceKeys.
+    """
     import bpy
     
     # http://blender.stackexchange.com/a/8392
     # http://blender.stackexchange.com/a/31709
 
-    try:
-        bpy.ops.object.mode_set(mode='EDIT')
-    except:
-        pass
+    if header.version not in [0, 2, 3, 4]:
+        raise ValueError("Version not supported", header.version)
 
     scene = bpy.context.scene
-    ob = bpy.context.object
-    eb = ob.data.edit_bones
-    bs = ob.data.bones
+    ob = armatureObj if armatureObj is not None else bpy.context.object
     pb = ob.pose.bones
 
-    restPose = {}
-    for b in bs:
-        rot = b.matrix_local.decompose()[1]
-
-        # multiply below by desired translation in world coords to get new
-        # "location" for pose
-        rotInv = rot.inverted() 
-
-        h = b.head_local  # absolute coordinate
-        if b.parent is not None:
-            ph = b.parent.head_local
+    rows, restRot, restHead = restPoseArrays(ob)
+    animBones = []
+    for b in boneList:
+        if b.name in rows:
+            animBones.append(b)
         else:
-            ph = mathutils.Vector([0,0,0])
-        h_rel = h - ph
-        restPose[b.name] = {'rot' : rot,
-                'rotInv' : rotInv,
-                'hPos' : h,
-                'hPosRel' : h_rel,
-                'parentPos' : ph
-        }
-
-    if header.version in [0, 2, 3]:
-        scene.frame_end = header.numFrames - 1
-        scene.frame_start = 0
-        for f in range(header.numFrames):
-            print("frame %s processing" % f)
-            scene.frame_set(f)
-            boneOrientations = {}
-            bonePositions = {}
-            for b in boneList:
-                n = b.name
-                boneOrientations[n] = b.orientations[f]
-                bonePositions[n] = b.positions[f]
-
-                armatureBone = eb[n]
-                poseBone = pb[n]
-                bone = bs[n]
-
-                if poseBone.parent:
-                    # armatureBone.head = poseBone.parent.tail
-                    parentName = poseBone.parent.name
-                    parOrientation = boneOrientations[parentName]
-                    # bPos.rotate(parOrientation)
-                    # boneOrientations[n] = parOrientation * b.orientations[f]
-                    # bonePositions[n] = bonePositions[parentName] + parOrientation * b.positions[f]
-                    # armatureBone.head = armatureBone.parent.tail
-                else:
-                    parOrientation = mathutils.Quaternion([1,0,0,0])
-
-                wantedPos = bonePositions[n]
-                # restPos = restPose[n]['h']
-                restPos = poseBone.head
-                rot = restPose[n]['rotInv']
-                newLoc = wantedPos - restPos
-                newLoc.rotate(rot)
-                poseBone.location = newLoc  #wantedPos - restPos
-
-                orient = (restPose[n]['rotInv'] * b.orientations[f] *
-                        restPose[n]['rot'])
-                poseBone.rotation_quaternion = orient
-                # poseBone.rotation_quaternion = parOrientation
-                # poseBone.rotation_quaternion = boneOrientations[n]
-                # armatureBone.tail = bPos
-                for dp in ["rotation_quaternion", "location"]:
-                    pb[n].keyframe_insert(data_path=dp, frame=f)
-            # ob.keyframe_insert(data_path="pose")
-                
-
-    elif header.version == 4:
-        raise NotImplementedError("version 4 not supported yet")
+            print("Bone %s not in armature, skipped" % b.name)
+    if not animBones:
+        raise ValueError("No animated bone is in the armature")
+    boneRows = [rows[b.name] for b in animBones]
+
+    # frames x bones arrays of the armature-space tracks
+    positions = np.array([b.positions for b in animBones]).swapaxes(0, 1)
+    orientations = np.array([b.orientations
+            for b in animBones]).swapaxes(0, 1)
+    locations, rotations = poseTracks(positions, orientations,
+            restRot[boneRows], restHead[boneRows])
+
+    scene.frame_end = header.numFrames - 1
+    scene.frame_start = 0
+    frames = np.arange(header.numFrames)
+
+    action = bpy.data.actions.new(name=actionName)
+    if ob.animation_data is None:
+        ob.animation_data_create()
+    ob.animation_data.action = action
+
+    if simplify:
+        keepLocations, keepRotations = reduceKeys(locations, rotations,
+                locationTolerance, angleTolerance)
+        interpolation = 'LINEAR'
+        print("Kept %d of %d keys" % (np.count_nonzero(keepLocations) +
+                np.count_nonzero(keepRotations), 2 * keepLocations.size))
     else:
-        raise ValueError("Version not supported", header.version)
-    # Once implemented, this code will probably follow a relatively simply
-    # structure to bone creation. Althought it will be:
-    # go by frame->insert key frame
-
-
-
-
+        keepLocations = keepRotations = np.ones(locations.shape[:2], bool)
+        interpolation = None
+
+    for i, b in enumerate(animBones):
+        pb[b.name].rotation_mode = 'QUATERNION'
+        keep = keepLocations[:, i]
+        addBoneFCurves(action, b.name, 'location', frames[keep],
+                locations[keep, i], interpolation)
+        keep = keepRotations[:, i]
+        addBoneFCurves(action, b.name, 'rotation_quaternion', frames[keep],
+                rotations[keep, i], interpolation)
+    return action
@@ -0,0 +1,220 @@
+# ##### BEGIN GPL LICENSE BLOCK ##### #
+# lolblender - Python addon to use League of Legends files into blender
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+"""On-disk cache of decoded files, keyed by file content.
+
+An entry holds the arrays a parser decoded, as .npy files that are memory
+mapped again on a hit, plus a meta.json for the small objects (headers,
+material tables, names).  Keys are the SHA-1 of the file contents, the
+kind of file and the parser's cache version, so edited files and parser
+changes never hit stale entries.  Entries are evicted least recently used
+first once the cache grows past maxBytes.
+
+The cache is off unless configure() is given a directory, or the
+LOLBLENDER_CACHE_DIR environment variable is set (LOLBLENDER_CACHE_MB
+bounds its size, 1024 by default).
+"""
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+
+cacheDirectory = None
+cacheMaxBytes = 1024 * 1024 * 1024
+#Running total of the entry sizes, None until the directory is walked
+cacheBytes = None
+
+
+def configure(directory, maxBytes=None):
+    """Enables the cache in directory (None disables it)"""
+    global cacheDirectory, cacheMaxBytes, cacheBytes
+    cacheDirectory = directory
+    cacheBytes = None
+    if maxBytes is not None:
+        cacheMaxBytes = maxBytes
+    if directory is not None:
+        os.makedirs(directory, exist_ok=True)
+
+
+def fileKey(kind, filepath, parserVersion):
+    """Hex key of a file's contents for a parser"""
+    digest = hashlib.sha1(('%s:%s:' % (kind, parserVersion)).encode())
+    with open(filepath, 'rb') as fid:
+        for chunk in iter(lambda: fid.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def entryPath(key):
+    return os.path.join(cacheDirectory, key[:2], key)
+
+
+def lookup(kind, filepath, parserVersion):
+    """Returns (key, entry).  key is None when the cache is off; entry is
+    None on a miss, else (meta, arrays) with arrays memory mapped read
+    only."""
+    if cacheDirectory is None:
+        return None, None
+    key = fileKey(kind, filepath, parserVersion)
+    path = entryPath(key)
+    metaPath = os.path.join(path, 'meta.json')
+    try:
+        with open(metaPath) as fid:
+            meta = json.load(fid)
+        arrays = dict((name, np.load(os.path.join(path, name + '.npy'),
+                mmap_mode='r')) for name in meta['arrays'])
+    except (OSError, ValueError, KeyError):
+        return key, None
+    try:
+        os.utime(metaPath, None)  # most recently used
+    except OSError:
+        pass
+    return key, (meta['meta'], arrays)
+
+
+def store(key, meta, arrays):
+    """Saves meta (json-able, see encodeState) and a {name: array} dict
+    under key, then evicts old entries if the cache has grown past
+    cacheMaxBytes.  Does nothing when key is None."""
+    global cacheBytes
+    if key is None or cacheDirectory is None:
+        return
+    path = entryPath(key)
+    if os.path.exists(path):
+        return
+    tmpPath = '%s.tmp%d' % (path, os.getpid())
+    try:
+        os.makedirs(tmpPath, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmpPath, name + '.npy'),
+                    np.ascontiguousarray(array))
+        with open(os.path.join(tmpPath, 'meta.json'), 'w') as fid:
+            json.dump({'meta': meta, 'arrays': list(arrays)}, fid)
+        os.rename(tmpPath, path)
+    except OSError as e:
+        print("Could not cache %s: %s" % (key, e))
+        shutil.rmtree(tmpPath, ignore_errors=True)
+        return
+    if cacheBytes is None:
+        cacheBytes = sum(size for used, size, entry in entries())
+    else:
+        cacheBytes += sum(os.path.getsize(os.path.join(path, f))
+                for f in os.listdir(path))
+    if cacheBytes > cacheMaxBytes:
+        evict()
+
+
+def entries():
+    """Lists (last use, size, path) of every entry"""
+    found = []
+    if cacheDirectory is None or not os.path.isdir(cacheDirectory):
+        return found
+    for prefix in os.listdir(cacheDirectory):
+        prefixPath = os.path.join(cacheDirectory, prefix)
+        if not os.path.isdir(prefixPath):
+            continue
+        for name in os.listdir(prefixPath):
+            path = os.path.join(prefixPath, name)
+            if '.tmp' in name or not os.path.isdir(path):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(path, f))
+                        for f in os.listdir(path))
+                used = os.path.getmtime(os.path.join(path, 'meta.json'))
+            except OSError:
+                continue
+            found.append((used, size, path))
+    return found
+
+
+def evict(maxBytes=None):
+    """Removes least recently used entries until the cache fits maxBytes
+    (default cacheMaxBytes)"""
+    global cacheBytes
+    if maxBytes is None:
+        maxBytes = cacheMaxBytes
+    found = sorted(entries())
+    total = sum(size for used, size, path in found)
+    for used, size, path in found:
+        if total <= maxBytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+    cacheBytes = total
+
+
+def encodeState(obj):
+    """The public attributes of a header-like object as json-able values.
+    bytes, tuples and dictionaries are tagged so decodeState can restore
+    them."""
+    return dict((name, encodeValue(value))
+            for name, value in vars(obj).items()
+            if not name.startswith('_'))
+
+
+def encodeValue(value):
+    if isinstance(value, bytes):
+        return {'bytes': value.decode('latin-1')}
+    if isinstance(value, tuple):
+        return {'tuple': [encodeValue(v) for v in value]}
+    if isinstance(value, list):
+        return [encodeValue(v) for v in value]
+    if isinstance(value, dict):
+        return {'dict': [[encodeValue(k), encodeValue(v)]
+                for k, v in value.items()]}
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def decodeState(state, obj):
+    """Sets the attributes saved by encodeState on obj and returns it"""
+    for name, value in state.items():
+        setattr(obj, name, decodeValue(value))
+    return obj
+
+
+def decodeValue(value):
+    if isinstance(value, list):
+        return [decodeValue(v) for v in value]
+    if isinstance(value, dict):
+        if 'bytes' in value:
+            return value['bytes'].encode('latin-1')
+        if 'tuple' in value:
+            return tuple(decodeValue(v) for v in value['tuple'])
+        if 'dict' in value:
+            return dict((decodeValue(k), decodeValue(v))
+                    for k, v in value['dict'])
+    return value
+
+
+def environmentMaxBytes(default=1024):
+    """LOLBLENDER_CACHE_MB in bytes, or default MB if it is unset or not
+    a number"""
+    try:
+        megabytes = int(os.environ.get('LOLBLENDER_CACHE_MB', default))
+        return megabytes * 1024 * 1024
+    except ValueError:
+        print("Ignoring LOLBLENDER_CACHE_MB=%r, using %d MB" %
+                (os.environ['LOLBLENDER_CACHE_MB'], default))
+        return default * 1024 * 1024
+
+
+configure(os.environ.get('LOLBLENDER_CACHE_DIR') or None,
+        environmentMaxBytes())
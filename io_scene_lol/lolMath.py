@@ -0,0 +1,82 @@
+# ##### BEGIN GPL LICENSE BLOCK ##### #
+# lolblender - Python addon to use League of Legends files into blender
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+"""Quaternion helpers working on whole numpy arrays at once.
+
+Quaternions are stored (w, x, y, z) in the last axis, like mathutils, and
+every function broadcasts over the leading axes (e.g. frames x bones).
+"""
+import numpy as np
+
+
+def quatMultiply(a, b):
+    """Hamilton product a * b"""
+    aw, ax, ay, az = np.rollaxis(np.asarray(a), -1)
+    bw, bx, by, bz = np.rollaxis(np.asarray(b), -1)
+    w = aw*bw - ax*bx - ay*by - az*bz
+    out = np.empty(w.shape + (4,), dtype=w.dtype)
+    out[..., 0] = w
+    out[..., 1] = aw*bx + ax*bw + ay*bz - az*by
+    out[..., 2] = aw*by - ax*bz + ay*bw + az*bx
+    out[..., 3] = aw*bz + ax*by - ay*bx + az*bw
+    return out
+
+
+def quatConjugate(q):
+    """Conjugate, which is the inverse of a unit quaternion"""
+    return np.asarray(q) * np.array([1, -1, -1, -1])
+
+
+def quatRotate(q, v):
+    """Rotates vectors v (last axis 3) by unit quaternions q"""
+    q = np.asarray(q)
+    v = np.asarray(v)
+    w = q[..., :1]
+    u = q[..., 1:]
+    t = 2 * np.cross(u, v)
+    return v + w * t + np.cross(u, t)
+
+
+def quatToMatrix(q):
+    """3 x 3 rotation matrices of unit quaternions q"""
+    w, x, y, z = np.rollaxis(np.asarray(q), -1)
+    out = np.empty(w.shape + (3, 3), dtype=w.dtype)
+    out[..., 0, 0] = 1 - 2*(y*y + z*z)
+    out[..., 0, 1] = 2*(x*y - w*z)
+    out[..., 0, 2] = 2*(x*z + w*y)
+    out[..., 1, 0] = 2*(x*y + w*z)
+    out[..., 1, 1] = 1 - 2*(x*x + z*z)
+    out[..., 1, 2] = 2*(y*z - w*x)
+    out[..., 2, 0] = 2*(x*z - w*y)
+    out[..., 2, 1] = 2*(y*z + w*x)
+    out[..., 2, 2] = 1 - 2*(x*x + y*y)
+    return out
+
+
+def quatMakeContinuous(q, axis=0):
+    """Flips signs along axis so consecutive quaternions lie in the same
+    hemisphere, which keeps interpolation between keys on the short arc"""
+    q = np.asarray(q)
+    if q.shape[axis] < 2:
+        return q
+    axis %= q.ndim
+    q = np.rollaxis(q, axis)
+    dots = np.sum(q[1:] * q[:-1], axis=-1)
+    flips = np.cumsum(dots < 0, axis=0) % 2
+    signs = np.concatenate([np.ones_like(flips[:1]), 1 - 2 * flips])
+    return np.rollaxis(q * signs[..., None], 0, axis + 1)
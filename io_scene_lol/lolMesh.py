@@ -17,7 +17,12 @@
 
 # <pep8 compliant>
 #from collections import UserDict
+import collections
+import mmap
+import os
 import struct
+import numpy as np
+from . import lolCache
 testFile = '/var/tmp/downloads/lol/Wolfman/Wolfman.skn'
     
 class sknHeader():
@@ -31,12 +36,13 @@ class sknHeader():
         self.numObjects = 0
         self.endTab = [0,0,0]
 
-    def fromFile(self, sknFid):
+    def fromFile(self, sknFid, verbose=True):
         buf = sknFid.read(self.__size__)
         (self.magic, self.version, 
                 self.numObjects) = struct.unpack(self.__format__, buf)
-        print("SKN version: %s" % self.version)
-        print("numObjects: %s" % self.numObjects)
+        if verbose:
+            print("SKN version: %s" % self.version)
+            print("numObjects: %s" % self.numObjects)
 
     def toFile(self, sknFid):
         buf = struct.pack(self.__format__, self.magic, self.version,
@@ -151,7 +157,7 @@ class sknMetaData():
 class sknVertex():
     def __init__(self):
         #UserDict.__init__(self)
-        self.__format__ = '<3f4b4f3f2f'
+        self.__format__ = '<3f4B4f3f2f'
         self.__size__ = struct.calcsize(self.__format__)
         self.reset()
 
@@ -181,6 +187,23 @@ class sknVertex():
                 self.texcoords[0],self.texcoords[1])
         sknFid.write(buf)
 
+
+#Bulk layouts of the index and vertex blocks.  sknVertexDtype matches
+#sknVertex's '<3f4B4f3f2f' record field for field (52 bytes).
+sknIndexDtype = np.dtype('<u2')
+sknVertexDtype = np.dtype([('position', '<f4', (3,)),
+        ('boneIndex', 'u1', (4,)),
+        ('weights', '<f4', (4,)),
+        ('normal', '<f4', (3,)),
+        ('texcoords', '<f4', (2,))])
+
+#Most vertices one material can address with 16 bit indices.  Meshes with
+#more vertices than this store each material's indices relative to its
+#startVertex.
+sknMaxVertices = 65535
+#Bump when importSKNArrays' results change, to invalidate lolCache entries
+sknCacheVersion = 1
+
 class scoObject():
 
     def __init__(self):
@@ -193,18 +216,17 @@ class scoObject():
         self.materialDict = {}
 
 
-def importSKN(filepath):
-    sknFid = open(filepath, 'rb')
-    print("Reading SKN: %s" % filepath)
-    #filepath = path.split(file)[-1]
-    #print(filepath)
+def readSKNTables(sknFid, verbose=True):
+    '''Reads the header, material list and meta data at the start of a
+    .skn file.  Leaves sknFid positioned at the start of the index block.'''
     header = sknHeader()
-    header.fromFile(sknFid)
+    header.fromFile(sknFid, verbose)
 
     materials = []
     buf = sknFid.read(struct.calcsize('<i'))
     numMaterials = struct.unpack('<i', buf)[0]
-    print ("number of Materials: %s" % numMaterials)
+    if verbose:
+        print ("number of Materials: %s" % numMaterials)
     for k in range(numMaterials):
         materials.append(sknMaterial())
         materials[-1].fromFile(sknFid)
@@ -212,79 +234,329 @@ def importSKN(filepath):
     metaData = sknMetaData()
     metaData.fromFile(sknFid, header.version)
 
-    indices = []
-    vertices = []
-    for k in range(metaData.numIndices):
-        buf = sknFid.read(struct.calcsize('<h'))
-        indices.append(struct.unpack('<h', buf)[0])
+    return header, materials, metaData
+
+def readSKNLayout(sknFid, verbose=True):
+    '''Reads the tables at the start of a .skn file (see readSKNTables) and,
+    for version 2+, the end block after the vertices into header.endTab,
+    seeking past the index and vertex data.  Returns header, materials,
+    metaData and the byte offsets of the index block, the vertex block and
+    the end of the vertex block.'''
+    header, materials, metaData = readSKNTables(sknFid, verbose)
+    indexOffset = sknFid.tell()
+    vertexOffset = indexOffset + metaData.numIndices * sknIndexDtype.itemsize
+    endOffset = vertexOffset + metaData.numVertices * sknVertexDtype.itemsize
+    if header.version >= 2:
+        sknFid.seek(endOffset)
+        buf = sknFid.read(struct.calcsize('<3i'))
+        if len(buf) != struct.calcsize('<3i'):
+            raise ValueError("Unexpected end of file reading the end block")
+        header.endTab = list(struct.unpack('<3i', buf))
+    return header, materials, metaData, indexOffset, vertexOffset, endOffset
+
+def probeSKN(filepath):
+    '''Describes a .skn file from its header and tables alone, without
+    reading the index or vertex data.  Returns a dictionary of version,
+    counts, materials (name and index/vertex ranges) and byte offsets.'''
+    with open(filepath, 'rb') as sknFid:
+        (header, materials, metaData, indexOffset, vertexOffset,
+                endOffset) = readSKNLayout(sknFid, verbose=False)
+        sknFid.seek(0, os.SEEK_END)
+        fileSize = sknFid.tell()
+    return {
+        'type': 'skn',
+        'version': header.version,
+        'magic': header.magic,
+        'numObjects': header.numObjects,
+        'numIndices': metaData.numIndices,
+        'numVertices': metaData.numVertices,
+        'numFaces': metaData.numIndices // 3,
+        'materials': [{
+            'name': sknMaterialName(mat),
+            'startVertex': mat.startVertex,
+            'numVertices': mat.numVertices,
+            'startIndex': mat.startIndex,
+            'numIndices': mat.numIndices,
+            } for mat in materials],
+        'indexOffset': indexOffset,
+        'vertexOffset': vertexOffset,
+        'endOffset': endOffset,
+        'fileSize': fileSize,
+        }
+
+def absoluteIndices(indices, materials, numVertices):
+    '''Returns indices as offsets into the whole vertex block.  Meshes with
+    more than sknMaxVertices vertices store each material's indices relative
+    to its startVertex; those are rebased into a wider array.'''
+    if numVertices <= sknMaxVertices:
+        return indices
+    indices = indices.astype(np.int32)
+    for mat in materials:
+        indices[mat.startIndex:mat.startIndex + mat.numIndices] += \
+                mat.startVertex
+    return indices
+
+def readArray(fid, dtype, count):
+    '''Reads count records of dtype from fid with a single read'''
+    buf = bytearray(count * dtype.itemsize)
+    if fid.readinto(buf) != len(buf):
+        raise ValueError("Unexpected end of file reading %d records" % count)
+    return np.frombuffer(buf, dtype, count)
+
+def importSKNArrays(filepath):
+    '''Reads a .skn file, decoding the index and vertex blocks in bulk.
+
+    Returns header, materials, metaData, indices, vertices.  indices is a 1d
+    array and vertices a sknVertexDtype array, so vertices['position'],
+    vertices['weights'], etc. give every vertex attribute at once.  With
+    lolCache enabled, unchanged files come back as read only arrays mapped
+    from the cache.
+    '''
+    key, cached = lolCache.lookup('skn', filepath, sknCacheVersion)
+    if cached is not None:
+        print("Reading SKN from cache: %s" % filepath)
+        meta, arrays = cached
+        header = lolCache.decodeState(meta['header'], sknHeader())
+        materials = [lolCache.decodeState(mat, sknMaterial())
+                for mat in meta['materials']]
+        metaData = lolCache.decodeState(meta['metaData'], sknMetaData())
+        return (header, materials, metaData, arrays['indices'],
+                arrays['vertices'])
 
-    for k in range(metaData.numVertices):
-        vertices.append(sknVertex())
-        vertices[-1].fromFile(sknFid)
+    sknFid = open(filepath, 'rb')
+    print("Reading SKN: %s" % filepath)
+    header, materials, metaData = readSKNTables(sknFid)
+
+    indices = readArray(sknFid, sknIndexDtype, metaData.numIndices)
+    indices = absoluteIndices(indices, materials, metaData.numVertices)
+    vertices = readArray(sknFid, sknVertexDtype, metaData.numVertices)
 
     # exclusive to version two+.
     if header.version >= 2:  # stuck in header b/c nowhere else for it
-        header.endTab = [struct.unpack('<3i', sknFid.read(struct.calcsize('<3i')))]
+        header.endTab = list(struct.unpack('<3i',
+                sknFid.read(struct.calcsize('<3i'))))
 
     sknFid.close()
 
+    lolCache.store(key, {
+        'header': lolCache.encodeState(header),
+        'materials': [lolCache.encodeState(mat) for mat in materials],
+        'metaData': lolCache.encodeState(metaData),
+        }, {'indices': indices, 'vertices': vertices})
     return header, materials, metaData, indices, vertices
 
+def verticesFromArray(vertexArray):
+    '''Builds a list of sknVertex objects from a sknVertexDtype array'''
+    columns = [[tuple(v) for v in vertexArray[name].tolist()]
+            for name in sknVertexDtype.names]
+    vertices = []
+    for (position, boneIndex, weights, normal,
+            texcoords) in zip(*columns):
+        vertices.append(sknVertex())
+        vertices[-1].position = position
+        vertices[-1].boneIndex = boneIndex
+        vertices[-1].weights = weights
+        vertices[-1].normal = normal
+        vertices[-1].texcoords = texcoords
+    return vertices
+
+def importSKN(filepath):
+    '''Reads a .skn file into sknVertex objects and a list of indices.
+    See importSKNArrays for the array based equivalent.'''
+    (header, materials, metaData, indices,
+            vertexArray) = importSKNArrays(filepath)
+
+    return (header, materials, metaData, indices.tolist(),
+            verticesFromArray(vertexArray))
+
+class sknAsset():
+    '''A .skn file parsed once, to be passed on to buildMesh,
+    addDefaultWeights etc. instead of re-reading the file.
+
+    header, materials, metaData, indices and vertices are as returned by
+    importSKNArrays.  obj is the Blender object built from it, if any.
+    '''
+
+    def __init__(self, filepath, header, materials, metaData, indices,
+            vertices):
+        self.filepath = filepath
+        self.header = header
+        self.materials = materials
+        self.metaData = metaData
+        self.indices = indices
+        self.vertices = vertices
+        self.obj = None
+
+    @property
+    def name(self):
+        '''File name without extension, i.e. path/to/Akali.skn -> Akali'''
+        return os.path.splitext(os.path.basename(self.filepath))[0]
+
+def loadSKN(filepath):
+    '''Reads a .skn file into a sknAsset'''
+    return sknAsset(filepath, *importSKNArrays(filepath))
+
+class sknView():
+    '''Memory mapped, lazily decoded view of a .skn file.
+
+    Only the header, material list and meta data are parsed on opening.
+    indices, vertices and the per attribute properties (position, boneIndex,
+    weights, normal, texcoords) are numpy views straight into the mapped
+    file, so nothing is copied or decoded until those values are used.
+
+    Arrays taken from a view are only valid until it is closed; use it as
+    a context manager or call close() when done.  indices are exactly as
+    stored, see absoluteIndices for meshes over sknMaxVertices vertices.
+    '''
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        with open(filepath, 'rb') as sknFid:
+            self._map = mmap.mmap(sknFid.fileno(), 0, access=mmap.ACCESS_READ)
+        self._indices = None
+        self._vertices = None
+
+        self.header, self.materials, self.metaData = readSKNTables(self._map)
+        self.indexOffset = self._map.tell()
+        self.vertexOffset = (self.indexOffset +
+                self.metaData.numIndices * sknIndexDtype.itemsize)
+        end = (self.vertexOffset +
+                self.metaData.numVertices * sknVertexDtype.itemsize)
+        if end > len(self._map):
+            self.close()
+            raise ValueError("Unexpected end of file in %s" % filepath)
+
+        if self.header.version >= 2:
+            self.header.endTab = list(struct.unpack_from('<3i',
+                    self._map, end))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        '''Releases the mapping.  If arrays from this view are still
+        referenced elsewhere the mapping is released along with them.'''
+        self._indices = None
+        self._vertices = None
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                pass
+            self._map = None
+
+    @property
+    def indices(self):
+        if self._indices is None:
+            self._indices = np.frombuffer(self._map, sknIndexDtype,
+                    self.metaData.numIndices, self.indexOffset)
+        return self._indices
+
+    @property
+    def vertices(self):
+        if self._vertices is None:
+            self._vertices = np.frombuffer(self._map, sknVertexDtype,
+                    self.metaData.numVertices, self.vertexOffset)
+        return self._vertices
+
+    @property
+    def position(self):
+        return self.vertices['position']
+
+    @property
+    def boneIndex(self):
+        return self.vertices['boneIndex']
+
+    @property
+    def weights(self):
+        return self.vertices['weights']
+
+    @property
+    def normal(self):
+        return self.vertices['normal']
+
+    @property
+    def texcoords(self):
+        return self.vertices['texcoords']
+
 def skn2obj(header, materials, indices, vertices):
-    objStr=""
-    if header.version > 0:
-        objStr+="g mat_%s\n" %(materials[0].name)
-    for vtx in vertices:
-        objStr+="v %f %f %f\n" %(vtx.position)
-        objStr+="vn %f %f %f\n" %(vtx.normal)
-        objStr+="vt %f %f\n" %(vtx.texcoords[0], 1-vtx.texcoords[1])
-
-    tmp = int(len(indices)/3)
-    for idx in range(tmp):
-        a = indices[3*idx][0] + 1
-        b = indices[3*idx + 1][0] + 1
-        c = indices[3*idx + 2][0] + 1
-        objStr+="f %d/%d/%d" %(a,a,a)
-        objStr+=" %d/%d/%d" %(b,b,b)
-        objStr+=" %d/%d/%d\n" %(c,c,c)
-
-    return objStr
-
-def buildMesh(filepath):
+    '''Formats a mesh read by importSKNArrays as Wavefront .obj text, with
+    a group per material.  Like buildMesh, the V texture coordinate is
+    flipped; positions are written as stored.'''
+    indices = np.asarray(indices, dtype=np.int64).ravel()
+    numVertices = len(vertices)
+    uvs = np.array(vertices['texcoords'], dtype=np.float64)
+    uvs[:, 1] = 1 - uvs[:, 1]
+
+    #Format whole blocks at once rather than line by line
+    lines = [
+        ("v %f %f %f\n" * numVertices) % tuple(
+                vertices['position'].ravel().tolist()),
+        ("vn %f %f %f\n" * numVertices) % tuple(
+                vertices['normal'].ravel().tolist()),
+        ("vt %f %f\n" * numVertices) % tuple(uvs.ravel().tolist()),
+        ]
+
+    #obj indices are 1 based, and each corner is v/vt/vn of one vertex
+    faces = indices[:len(indices) // 3 * 3].reshape(-1, 3) + 1
+    groups = [(sknMaterialName(mat), mat.startIndex // 3,
+            (mat.startIndex + mat.numIndices) // 3) for mat in materials]
+    if header.version == 0 or not groups:
+        groups = [('default', 0, len(faces))]
+    for name, first, last in groups:
+        corners = np.repeat(faces[first:last], 3, axis=1)
+        lines.append("g mat_%s\nusemtl %s\n" % (name, name))
+        lines.append(("f %d/%d/%d %d/%d/%d %d/%d/%d\n" * len(corners)) %
+                tuple(corners.ravel().tolist()))
+
+    return ''.join(lines)
+
+def sknMaterialName(mat):
+    '''Decodes a sknMaterial's null padded name'''
+    return mat.name.split(b'\0')[0].decode('latin-1')
+
+def buildMesh(skn):
+    '''Builds a mesh object from a sknAsset (or .skn file path) and links
+    it to the scene.  Returns the object, which is also kept as skn.obj.'''
     import bpy
-    from os import path
-    (header, materials, metaData, indices, vertices) = importSKN(filepath)
-    ''' 
-    if header.version > 0 and materials[0].numMaterials == 2:
-        print('ERROR:  Skins with numMaterials = 2 are currently unreadable.  Exiting')
-        return{'CANCELLED'} 
-    '''
-    numIndices = len(indices)
+    if not isinstance(skn, sknAsset):
+        skn = loadSKN(skn)
+    materials = skn.materials
+    indices = skn.indices
+    vertices = skn.vertices
+    numFaces = len(indices) // 3
+    numIndices = 3 * numFaces
     numVertices = len(vertices)
-    #Create face groups
-    faceList = []
-    for k in range(0, numIndices, 3):
-        #faceList.append( [indices[k], indices[k+1], indices[k+2]] )
-        faceList.append( indices[k:k+3] )
-
-    vtxList = []
-    normList = []
-    uvList = []
-    for vtx in vertices:
-        vtxList.append( vtx.position[:] )
-        normList.extend( vtx.normal[:] )
-        uvList.append( [vtx.texcoords[0], 1-vtx.texcoords[1]] )
+
+    #Flat per-element buffers for foreach_set
+    positions = np.ascontiguousarray(vertices['position']).ravel()
+    normals = np.ascontiguousarray(vertices['normal']).ravel()
+    loopVertices = indices[:numIndices].astype(np.int32)
+    loopStarts = np.arange(0, numIndices, 3, dtype=np.int32)
+    loopTotals = np.full(numFaces, 3, dtype=np.int32)
+
+    #UVs are per loop; the V coordinate is flipped for Blender
+    uvs = np.array(vertices['texcoords'], dtype=np.float32)
+    uvs[:, 1] = 1 - uvs[:, 1]
+    loopUvs = uvs[loopVertices].ravel()
 
     #Build the mesh
     #Get current scene
     scene = bpy.context.scene
     #Create mesh
     #Use the filename base as the meshname.  i.e. path/to/Akali.skn -> Akali
-    meshName = path.split(filepath)[-1]
-    meshName = path.splitext(meshName)[0]
-    mesh = bpy.data.meshes.new(meshName)
-    mesh.from_pydata(vtxList, [], faceList)
-    mesh.update()
+    mesh = bpy.data.meshes.new(skn.name)
+    mesh.vertices.add(numVertices)
+    mesh.loops.add(numIndices)
+    mesh.polygons.add(numFaces)
+    mesh.vertices.foreach_set('co', positions)
+    mesh.loops.foreach_set('vertex_index', loopVertices)
+    mesh.polygons.foreach_set('loop_start', loopStarts)
+    mesh.polygons.foreach_set('loop_total', loopTotals)
+    mesh.update(calc_edges=True)
 
     bpy.ops.object.select_all(action='DESELECT')
     
@@ -296,38 +568,42 @@ def buildMesh(filepath):
 
 
     #Create UV texture coords
-    texList = []
     uvtexName = 'lolUVtex'
     obj.data.uv_textures.new(uvtexName)
     uv_layer = obj.data.uv_layers[-1].data  # sets layer to the above texture
-    set = []
-    for k, loop in enumerate(obj.data.loops):
-        # data.loops contains the vertex of tris
-        # k/3 = triangle #
-        # k%3 = vertex number in that triangle
-        v = loop.vertex_index  # "index" number
-        set.append(uvList[v][0])  # u
-        set.append(uvList[v][1])  # v
-    uv_layer.foreach_set("uv", set)
+    uv_layer.foreach_set("uv", loopUvs)
 
     #Set normals
     #Needs to be done after the UV unwrapping 
-    obj.data.vertices.foreach_set('normal', normList) 
-
-    #Create material
-    materialName = 'lolMaterial'
-    #material = bpy.data.materials.ne(materialName)
+    obj.data.vertices.foreach_set('normal', normals) 
+
+    #Create a material slot per distinct .skn material name and assign
+    #every polygon its slot from the materials' index ranges
+    slots = {}
+    faceSlots = np.zeros(numFaces, dtype=np.int32)
+    for mat in materials:
+        materialName = sknMaterialName(mat)
+        if materialName not in slots:
+            material = bpy.data.materials.new(materialName)
+            material['sknName'] = materialName
+            mesh.materials.append(material)
+            slots[materialName] = len(slots)
+        faceSlots[mat.startIndex // 3:
+                (mat.startIndex + mat.numIndices) // 3] = slots[materialName]
+    mesh.polygons.foreach_set('material_index', faceSlots)
     mesh.update() 
     #set active
     obj.select = True
 
-    return {'FINISHED'}
+    skn.obj = obj
+    return obj
     
-def addDefaultWeights(boneList, sknVertices, armatureObj, meshObj):
+def addDefaultWeights(boneList, sknVertices, armatureObj, meshObj,
+        boneIDs=None, weightStep=1.0/1024):
 
     '''Add an armature modifier to the mesh'''
-    meshObj.modifiers.new(name='Armature', type='ARMATURE')
-    meshObj.modifiers['Armature'].object = armatureObj
+    modifier = meshObj.modifiers.new(name='Armature', type='ARMATURE')
+    modifier.object = armatureObj
 
     '''
     Blender bone deformations create vertex groups with names corresponding to
@@ -341,18 +617,468 @@ def addDefaultWeights(boneList, sknVertices, armatureObj, meshObj):
         meshObj.vertex_groups.new(name=bone.name)
 
     '''
-    Loop over vertices by index & add weights
+    Vertex bone indices refer to boneIDs (the skeleton's reordered bone list)
+    when it is given, so remap them to vertex group indices with a lookup
+    table.  The table is kept on the mesh for exportSKN.
+    '''
+    numGroups = len(boneList)
+    if boneIDs:
+        groupLookup = np.asarray(boneIDs, dtype=np.intp)
+        if groupLookup.min() < 0 or groupLookup.max() >= numGroups:
+            raise ValueError("SKL bone ID out of range (%d to %d, %d bones)"
+                    % (groupLookup.min(), groupLookup.max(), numGroups))
+        meshObj['lolBoneIDs'] = list(boneIDs)
+    else:
+        groupLookup = np.arange(numGroups)
+
+    if isinstance(sknVertices, np.ndarray):
+        boneIndex = sknVertices['boneIndex']
+        weights = sknVertices['weights']
+    else:
+        boneIndex = [vtx.boneIndex for vtx in sknVertices]
+        weights = [vtx.weights for vtx in sknVertices]
+    boneIndex = np.asarray(boneIndex, dtype=np.intp)
+    weights = np.asarray(weights, dtype=np.float64)
+
+    '''
+    Flatten the four influences of every vertex, drop zero weights and
+    merge repeated influences of one bone on a vertex
     '''
-    for vtx_idx, vtx in enumerate(sknVertices):
-        for k in range(4):
-            boneId = vtx.boneIndex[k]
-            weight = vtx.weights[k]
+    vtxIdx = np.repeat(np.arange(len(weights)), 4)
+    boneIndex = boneIndex.ravel()
+    weights = weights.ravel()
+    used = weights > 0
+    vtxIdx, boneIndex, weights = vtxIdx[used], boneIndex[used], weights[used]
+    if len(boneIndex) and boneIndex.max() >= len(groupLookup):
+        raise ValueError("Vertex bone index %d out of range (%d bones)" %
+                (boneIndex.max(), len(groupLookup)))
+    groups = groupLookup[boneIndex]
+
+    pairs, pairIdx = np.unique(vtxIdx * numGroups + groups,
+            return_inverse=True)
+    weights = np.bincount(pairIdx.ravel(), weights=weights)
+    vtxIdx = pairs // numGroups
+    groups = pairs % numGroups
 
-            meshObj.vertex_groups[boneId].add([vtx_idx],
-                    weight,
-                    'ADD')
+    '''
+    Bucket by (group, quantized weight) so that each vertex_groups add call
+    takes every vertex sharing that weight
+    '''
+    levels = np.round(weights / weightStep).astype(np.int64)
+    order = np.lexsort((vtxIdx, levels, groups))
+    vtxIdx, levels, groups = vtxIdx[order], levels[order], groups[order]
+    starts = np.flatnonzero(np.diff(groups) | np.diff(levels)) + 1
+    starts = np.concatenate(([0], starts))
+    ends = np.concatenate((starts[1:], [len(vtxIdx)]))
+
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        weight = min(levels[start] * weightStep, 1.0)
+        meshObj.vertex_groups[int(groups[start])].add(
+                vtxIdx[start:end].tolist(), weight, 'REPLACE')
+
+def groupBoneIndices(meshObj):
+    '''Maps each of meshObj's vertex groups to the .skn bone index it is
+    exported as, or -1 if the group's bone is not in the skin's bone list'''
+    numGroups = len(meshObj.vertex_groups)
+    if 'lolBoneIDs' not in meshObj:
+        return np.arange(numGroups)
+
+    groupBones = np.full(numGroups, -1, dtype=np.intp)
+    #first entry wins if a bone is listed twice
+    for sknIdx, boneId in reversed(list(enumerate(meshObj['lolBoneIDs']))):
+        if 0 <= boneId < numGroups:
+            groupBones[boneId] = sknIdx
+    return groupBones
+
+def topInfluences(counts, groups, weights, groupBones=None,
+        numInfluences=4):
+    '''Picks the numInfluences largest weights of every vertex and
+    renormalizes them to sum to 1.
+
+    counts, groups and weights hold the vertex group weights in CSR form:
+    vertex k owns the counts[k] entries after those of vertex k-1.  Group
+    indices are translated through groupBones when given; groups mapped to
+    -1 are ignored.  Returns boneIndex and weights arrays of shape
+    (len(counts), numInfluences), largest weight first.  Vertices with no
+    weight left get all-zero weights.
+    '''
+    counts = np.asarray(counts, dtype=np.intp)
+    groups = np.asarray(groups, dtype=np.intp)
+    weights = np.asarray(weights, dtype=np.float64)
+    numVertices = len(counts)
+    if groupBones is not None:
+        groups = np.asarray(groupBones, dtype=np.intp)[groups]
+        weights = np.where(groups >= 0, weights, 0.0)
+        groups = np.maximum(groups, 0)
+
+    #Scatter the CSR rows into a dense (vertices x widest row) matrix
+    width = max(int(counts.max()) if numVertices else 0, numInfluences)
+    rows = np.repeat(np.arange(numVertices), counts)
+    rowStarts = np.cumsum(counts) - counts
+    cols = np.arange(len(groups)) - np.repeat(rowStarts, counts)
+    denseWeights = np.zeros((numVertices, width))
+    denseBones = np.zeros((numVertices, width), dtype=np.intp)
+    denseWeights[rows, cols] = weights
+    denseBones[rows, cols] = groups
+
+    #argpartition leaves the largest numInfluences in the first columns.
+    #Rows are gathered with fancy indexing rather than take_along_axis,
+    #which the NumPy shipped with older Blender releases lacks.
+    rowIdx = np.arange(numVertices)[:, None]
+    if width > numInfluences:
+        top = np.argpartition(-denseWeights, numInfluences - 1,
+                axis=1)[:, :numInfluences]
+        denseWeights = denseWeights[rowIdx, top]
+        denseBones = denseBones[rowIdx, top]
+    order = np.argsort(-denseWeights, axis=1, kind='mergesort')
+    topWeights = denseWeights[rowIdx, order]
+    topBones = denseBones[rowIdx, order]
+
+    total = topWeights.sum(axis=1, keepdims=True)
+    topWeights = np.divide(topWeights, total,
+            out=np.zeros_like(topWeights), where=total > 0)
+    topBones[topWeights == 0] = 0
+    numEmpty = int(np.count_nonzero(total == 0))
+    if numEmpty:
+        print("%d vertices have no bone weights" % numEmpty)
+
+    return topBones, topWeights
+
+def weldVertices(loopVertices, tolerance=1e-5):
+    '''Merges vertices whose position, normal, uv and weights all match.
+
+    loopVertices is a sknVertexDtype array with one entry per index (per
+    loop).  Every float attribute is snapped to a grid of size tolerance
+    and the snapped records are hashed, so a Blender vertex is split only
+    where its loops really differ (UV seams) and separate vertices that
+    are identical are joined.  Returns indices, vertices with the vertices
+    in order of first use.
+    '''
+    if len(loopVertices) == 0:
+        return (np.zeros(0, dtype=np.int32),
+                np.zeros(0, dtype=sknVertexDtype))
+    keys = [loopVertices['boneIndex'].astype(np.int64)]
+    for name in ['position', 'weights', 'normal', 'texcoords']:
+        keys.append(np.round(loopVertices[name] /
+                tolerance).astype(np.int64))
+    keys = np.concatenate(keys, axis=1)
+
+    #Row-wise unique by a lexicographic sort (np.unique only takes axis=0
+    #from NumPy 1.13).  lexsort is stable, so the first loop of each run
+    #of equal keys is the first loop using that vertex.
+    sortOrder = np.lexsort(keys.T[::-1])
+    sortedKeys = keys[sortOrder]
+    isNew = np.ones(len(keys), dtype=bool)
+    isNew[1:] = np.any(sortedKeys[1:] != sortedKeys[:-1], axis=1)
+    firstLoop = sortOrder[isNew]
+    loopKey = np.empty(len(keys), dtype=np.intp)
+    loopKey[sortOrder] = np.cumsum(isNew) - 1
+
+    #renumber the unique vertices in the order they are first used
+    order = np.argsort(firstLoop, kind='mergesort')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+
+    indices = rank[loopKey].astype(np.int32)
+    vertices = loopVertices[firstLoop[order]]
+    return indices, vertices
+
+def meshToSKNArrays(mesh, groupBones=None, tolerance=1e-5):
+    '''Pulls a Blender mesh into SKN index and vertex arrays.
+
+    Positions, normals, loop vertex indices and UVs are read with
+    foreach_get into flat buffers; the mesh's vertex groups become the
+    boneIndex/weights fields, translated through groupBones (see
+    groupBoneIndices) when given.  Vertices are split along UV seams and
+    duplicates welded with weldVertices.  Returns indices, vertices where
+    vertices is a sknVertexDtype array.
+    '''
+    numVertices = len(mesh.vertices)
+    numLoops = len(mesh.loops)
+
+    positions = np.empty(numVertices * 3, np.float32)
+    normals = np.empty(numVertices * 3, np.float32)
+    indices = np.empty(numLoops, np.int32)
+    uvs = np.empty(numLoops * 2, np.float32)
+    mesh.vertices.foreach_get('co', positions)
+    mesh.vertices.foreach_get('normal', normals)
+    mesh.loops.foreach_get('vertex_index', indices)
+    mesh.uv_layers['lolUVtex'].data.foreach_get('uv', uvs)
+
+    vertices = np.zeros(numVertices, sknVertexDtype)
+    vertices['position'] = positions.reshape(-1, 3)
+    vertices['normal'] = normals.reshape(-1, 3)
+
+    #get weights
+    #Collect every vertex's group weights in one pass (CSR layout), then
+    #keep the largest 4 per vertex since that is all the SKN format allows
+    counts = np.zeros(numVertices, dtype=np.intp)
+    groupWeights = []
+    for idx, vtx in enumerate(mesh.vertices):
+        counts[idx] = len(vtx.groups)
+        groupWeights.extend((group.group, group.weight) for group in vtx.groups)
+    groupWeights = np.array(groupWeights, dtype=np.float64).reshape(-1, 2)
+
+    boneIndex, weights = topInfluences(counts,
+            groupWeights[:, 0].astype(np.intp), groupWeights[:, 1],
+            groupBones)
+    if numVertices and boneIndex.max() > 255:
+        raise ValueError("Bone index %d does not fit in a byte" %
+                boneIndex.max())
+    vertices['boneIndex'] = boneIndex
+    vertices['weights'] = weights
+
+    #UVs belong to loops, so expand to one vertex per loop before welding.
+    #The V coordinate need to be flipped back - it was flipped on importing.
+    loopVertices = vertices[indices]
+    uvs = uvs.reshape(-1, 2)
+    uvs[:, 1] = 1 - uvs[:, 1]
+    loopVertices['texcoords'] = uvs
+
+    return weldVertices(loopVertices, tolerance)
+
+def cacheStats(indices, cacheSize=16):
+    '''Simulates a FIFO post-transform vertex cache of cacheSize entries.
+    Returns ACMR (vertex transforms per triangle) and ATVR (transforms per
+    referenced vertex); 0.5-0.7 and 1.0 are about the best possible.'''
+    indices = np.asarray(indices)
+    if len(indices) < 3:
+        return 0.0, 0.0
+    cache = collections.deque()
+    inCache = set()
+    misses = 0
+    for v in indices.tolist():
+        if v not in inCache:
+            misses += 1
+            cache.append(v)
+            inCache.add(v)
+            if len(cache) > cacheSize:
+                inCache.discard(cache.popleft())
+    return (misses / (len(indices) // 3),
+            misses / len(np.unique(indices)))
+
+def optimizeVertexCache(indices, numVertices=None, cacheSize=16):
+    '''Reorders triangles for post-transform vertex cache locality.
+
+    Uses Tipsify (Sander, Nehab, Barczak 2007): fan out around the most
+    recently cached vertex that still has triangles left, falling back to
+    recently used vertices and then the lowest unfinished index.  It runs
+    in linear time.  Only the triangle order changes; see
+    renumberByFirstUse to also make vertex fetch linear.
+    '''
+    indices = np.asarray(indices)
+    numFaces = len(indices) // 3
+    tris = indices[:3 * numFaces].astype(np.intp)
+    if numVertices is None:
+        numVertices = int(tris.max()) + 1 if numFaces else 0
+
+    #vertex -> triangle adjacency in CSR form
+    useCount = np.bincount(tris, minlength=numVertices)
+    adjStart = np.concatenate(([0], np.cumsum(useCount))).tolist()
+    adjTris = (np.argsort(tris, kind='mergesort') // 3).tolist()
+    live = useCount.tolist()
+    triVerts = tris.tolist()
+
+    cacheTime = [0] * numVertices
+    emitted = [False] * numFaces
+    deadEnd = []
+    order = []
+    stamp = cacheSize + 1
+    cursor = 0
+    fanning = 0 if numFaces else -1
+    while fanning >= 0:
+        candidates = []
+        for t in adjTris[adjStart[fanning]:adjStart[fanning + 1]]:
+            if emitted[t]:
+                continue
+            emitted[t] = True
+            order.append(t)
+            for v in triVerts[3 * t:3 * t + 3]:
+                deadEnd.append(v)
+                candidates.append(v)
+                live[v] -= 1
+                if stamp - cacheTime[v] > cacheSize:
+                    cacheTime[v] = stamp
+                    stamp += 1
+
+        #next fanning vertex: the one staying in cache longest
+        fanning = -1
+        best = -1
+        for v in candidates:
+            if live[v] > 0:
+                priority = 0
+                if stamp - cacheTime[v] + 2 * live[v] <= cacheSize:
+                    priority = stamp - cacheTime[v]
+                if priority > best:
+                    best = priority
+                    fanning = v
+
+        #dead end: back up through recent vertices, then scan forward
+        while fanning < 0 and deadEnd:
+            v = deadEnd.pop()
+            if live[v] > 0:
+                fanning = v
+        while fanning < 0 and cursor < numVertices:
+            if live[cursor] > 0:
+                fanning = cursor
+            cursor += 1
+
+    return tris.reshape(-1, 3)[order].ravel()
+
+def renumberByFirstUse(indices, vertices):
+    '''Reorders vertices in the order indices first reference them and
+    rewrites indices to match.  Unreferenced vertices are dropped.'''
+    indices = np.asarray(indices)
+    used, firstUse = np.unique(indices, return_index=True)
+    order = used[np.argsort(firstUse, kind='mergesort')]
+    remap = np.zeros(len(vertices), dtype=np.int32)
+    remap[order] = np.arange(len(order))
+    return remap[indices], vertices[order]
+
+def partitionSubmesh(indices, vertices, maxVertices=sknMaxVertices):
+    '''Splits a mesh into pieces of at most maxVertices vertices each.
+
+    Triangles are taken in their current order (cache optimized, so
+    neighbouring triangles share vertices) and a new piece is started
+    whenever the next triangle would overflow the current one, so each
+    piece covers a compact region.  Vertices on a cut are duplicated.
+    Returns a list of (indices, vertices) with indices local to the piece.
+    '''
+    indices = np.asarray(indices)
+    if len(vertices) <= maxVertices:
+        return [(indices, vertices)]
+
+    triVerts = indices.reshape(-1, 3).tolist()
+    cuts = []
+    used = set()
+    for t, tri in enumerate(triVerts):
+        newVerts = len(set(tri) - used)
+        if len(used) + newVerts > maxVertices:
+            cuts.append(t)
+            used = set()
+        used.update(tri)
+
+    pieces = []
+    for triIdx in np.split(np.arange(len(triVerts)), cuts):
+        pieceIdx = indices.reshape(-1, 3)[triIdx].ravel()
+        pieces.append(renumberByFirstUse(pieceIdx, vertices))
+    return pieces
+
+def joinSubmeshes(submeshes):
+    '''Lays out (name, indices, vertices) submeshes one after another.
+
+    Returns the sknMaterial list with each submesh's startVertex/startIndex
+    range and the combined indices and vertices.  Indices are global unless
+    the total passes sknMaxVertices, in which case they are written relative
+    to their material's startVertex (see absoluteIndices).
+    '''
+    numVertices = sum(len(vertices) for name, indices, vertices in submeshes)
+    relative = numVertices > sknMaxVertices
 
-def exportSKN(meshObj, output_filepath, input_filepath, BASE_ON_IMPORT, VERSION):
+    materials = []
+    allIndices = []
+    allVertices = []
+    startVertex = 0
+    startIndex = 0
+    for name, indices, vertices in submeshes:
+        materials.append(sknMaterial(name, startVertex, len(vertices),
+                startIndex, len(indices)))
+        indices = np.asarray(indices, dtype=np.int64)
+        allIndices.append(indices if relative else indices + startVertex)
+        allVertices.append(vertices)
+        startVertex += len(vertices)
+        startIndex += len(indices)
+
+    if not submeshes:
+        return (materials, np.zeros(0, dtype=np.int64),
+                np.zeros(0, dtype=sknVertexDtype))
+    return (materials, np.concatenate(allIndices),
+            np.concatenate(allVertices))
+
+def stackIndices(indexLists):
+    '''Concatenates per submesh indices, offsetting each one past the
+    vertices used by the ones before it'''
+    stacked = []
+    offset = 0
+    for indices in indexLists:
+        stacked.append(np.asarray(indices, dtype=np.int64) + offset)
+        if len(indices):
+            offset += int(np.max(indices)) + 1
+    if not stacked:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(stacked)
+
+def buildSubmeshes(indices, vertices, faceMaterials, names, optimize=True):
+    '''Groups triangles by material into (name, indices, vertices)
+    submeshes, each with its own contiguous vertex range.
+
+    faceMaterials holds one index into names per triangle.  With optimize,
+    each submesh is reordered for the vertex cache and ACMR/ATVR are
+    reported.  Submeshes over sknMaxVertices are partitioned.
+    '''
+    triangles = np.asarray(indices).reshape(-1, 3)
+    faceMaterials = np.asarray(faceMaterials)
+    submeshes = []
+    before = []
+    after = []
+    for slot in np.unique(faceMaterials).tolist():
+        subIdx, subVtx = renumberByFirstUse(
+                triangles[faceMaterials == slot].ravel(), vertices)
+        if optimize:
+            before.append(subIdx)
+            subIdx = optimizeVertexCache(subIdx, len(subVtx))
+            subIdx, subVtx = renumberByFirstUse(subIdx, subVtx)
+        for pieceIdx, pieceVtx in partitionSubmesh(subIdx, subVtx):
+            submeshes.append((names[slot], pieceIdx, pieceVtx))
+            if optimize:
+                after.append(pieceIdx)
+
+    if optimize:
+        before = cacheStats(stackIndices(before))
+        after = cacheStats(stackIndices(after))
+        print("Vertex cache ACMR %.3f -> %.3f, ATVR %.3f -> %.3f" %
+                (before[0], after[0], before[1], after[1]))
+    return submeshes
+
+def writeSKN(filepath, header, materials, metaData, indices, vertices,
+        version):
+    '''Writes a .skn file.  The index and vertex sections are assembled in
+    memory and each written with a single call.'''
+    indices = np.asarray(indices)
+    if len(indices) and (indices.min() < np.iinfo(sknIndexDtype).min or
+            indices.max() > np.iinfo(sknIndexDtype).max):
+        raise ValueError("Vertex indices out of range for the SKN format")
+    indexBuf = indices.astype(sknIndexDtype).tobytes()
+    vertexBuf = np.asarray(vertices, sknVertexDtype).tobytes()
+
+    sknFid = open(filepath, 'wb')
+    
+    #write header
+    header.toFile(sknFid)
+    if header.numObjects > 0:  # if materials exist
+        sknFid.write(struct.pack('<1i', len(materials)))
+        #We are writing a materials block
+        for mat in materials:
+            mat.toFile(sknFid)
+
+    metaData.toFile(sknFid, version)
+
+    sknFid.write(indexBuf)
+    sknFid.write(vertexBuf)
+
+    if version >= 2:  # some extra ints in v2+. not sure what they do, non-0 in v4?
+        if header.endTab is None or len(header.endTab) < 3:
+            header.endTab = [0, 0, 0]
+        sknFid.write(struct.pack('<3i', header.endTab[0], header.endTab[1], header.endTab[2]))
+
+    #Close the output file
+    sknFid.close()
+
+def exportSKN(meshObj, output_filepath, input_filepath, BASE_ON_IMPORT, VERSION,
+        TOLERANCE=1e-5, OPTIMIZE=True):
+    '''Exports meshObj as a .skn file.  TOLERANCE is the snapping distance
+    used when splitting vertices along UV seams and welding duplicates.
+    OPTIMIZE reorders triangles and vertices for the GPU vertex cache.'''
     import bpy
 
     if VERSION not in [1,2,4] and not BASE_ON_IMPORT:
@@ -363,135 +1089,68 @@ def exportSKN(meshObj, output_filepath, input_filepath, BASE_ON_IMPORT, VERSION)
     bpy.ops.object.select_all(action='DESELECT')
     meshObj.select = True
 
-    numFaces = len(meshObj.data.loops) // 3
-    
-    #Build vertex index list and dictionary of vertex-uv pairs
-    indices = []
-    vtxUvs = {}
-    for idx, loop in enumerate(meshObj.data.loops):
-        vertex = loop.vertex_index
-        indices.append(vertex)
-        #The V coordinate need to be flipped back - it was flipped on importing.
-        uv = meshObj.data.uv_layers['lolUVtex'].data[idx].uv
-        vtxUvs[vertex] = [uv[0], 1-uv[1]]
-        
-    numIndices = len(indices)
-    numVertices = len(meshObj.data.vertices)
+    #Loops are written straight out as index triples, so every polygon
+    #must be a triangle (one material index per triangle then)
+    numFaces = len(meshObj.data.polygons)
+    loopTotals = np.empty(numFaces, dtype=np.int32)
+    meshObj.data.polygons.foreach_get('loop_total', loopTotals)
+    numOther = int(np.count_nonzero(loopTotals != 3))
+    if numOther:
+        raise ValueError("%d faces of %s are not triangles; triangulate "
+                "the mesh before exporting" % (numOther, meshObj.name))
+
+    indices, vertices = meshToSKNArrays(meshObj.data,
+            groupBoneIndices(meshObj), TOLERANCE)
+    faceMaterials = np.empty(numFaces, dtype=np.int32)
+    meshObj.data.polygons.foreach_get('material_index', faceMaterials)
 
     #Write header block
     if BASE_ON_IMPORT:
-        (import_header, import_mats, import_meta_data, import_indices,
-        import_vertices) = importSKN(input_filepath)
+        #Only the tables are needed, not the index and vertex data
+        with open(input_filepath, 'rb') as sknFid:
+            (import_header, import_mats, import_meta_data) = readSKNLayout(
+                    sknFid)[0:3]
         header = import_header
         VERSION = header.version
         
-        numMats = len(import_mats)
-        if numMats > 1:
-            raise ValueError("More than 1 material (%d); not supported" % numMats)
-        matHeaders = import_mats
+        defaultName = import_mats[0].name if import_mats else b'test'
 
         meta_data = import_meta_data
-        
-        #override previous #verts, #idxs so no memory error!
-        matHeaders[0].numIndices = numIndices
-        matHeaders[0].numVertices = numVertices
-        meta_data.numIndices = numIndices
-        meta_data.numVertices = numVertices
     else:
         header = sknHeader()
         header.magic = 1122867
         header.version = VERSION
         header.numObjects = 1
 
-        numMats = 1
-        matHeaders = []
-        mat = sknMaterial(b'test', 0, numVertices, 0, numIndices)
-        matHeaders.append(mat)
-
-        meta_data = sknMetaData(0, numIndices, numVertices)
-
-    #create output file 
-    sknFid = open(output_filepath, 'wb')
-    
-    #write header
-    header.toFile(sknFid)
-    if header.numObjects > 0:  # if materials exist
-        sknFid.write(struct.pack('<1i', numMats))
-        #We are writing a materials block
-        for mat in matHeaders:
-            mat.toFile(sknFid)
+        defaultName = b'test'
 
-    meta_data.toFile(sknFid, VERSION)
-
-    #write face indices
-    for idx in indices:
-        buf = struct.pack('<h', idx)
-        sknFid.write(buf)
-
-    #Write vertices
-    sknVtx = sknVertex()
-    for idx, vtx in enumerate(meshObj.data.vertices):
-        sknVtx.reset()
-        #get position
-        sknVtx.position[0] = vtx.co[0]
-        sknVtx.position[1] = vtx.co[1]
-        sknVtx.position[2] = vtx.co[2]
-        
-        sknVtx.normal[0] = vtx.normal[0]
-        sknVtx.normal[1] = vtx.normal[1]
-        sknVtx.normal[2] = vtx.normal[2]
-
-        #get weights
-        #The SKN format only allows 4 bone weights,
-        #so we'll choose the largest 4 & renormalize
-        #if needed
-
-        if len(vtx.groups) > 4:
-            tmpList = []
-            #Get all the bone/weight pairs
-            for group in vtx.groups:
-                tmpList.append((group.group, group.weight))
-
-            #Sort by weight in decending order
-            tmpList = sorted(tmpList, key=lambda t: t[1], reverse=True)
-            
-            #Find sum of four largets weights.
-            tmpSum = 0
-            for k in range(4):
-                tmpSum += tmpList[k][1]
-            
-            #Spread remaining weight proportionally across bones
-            remWeight = 1-tmpSum
-            for k in range(4):
-                sknVtx.boneIndex[k] = tmpList[k][0]
-                sknVtx.weights[k] = tmpList[k][1] + tmpList[k][1]*remWeight/tmpSum
+        meta_data = sknMetaData(0, 0, 0)
 
+    #One .skn material per used material slot, named after the slot's
+    #material (or the name it was imported with)
+    names = []
+    for material in meshObj.data.materials:
+        if material is None:
+            names.append(defaultName)
         else:
-            #If we have 4 or fewer bone/weight associations,
-            #we have to ensure that the sum of the weights is 1
-            weightSum = 0.0
-            for group in vtx.groups:
-                weightSum += group.weight
-            
-            for vtxIdx, group in enumerate(vtx.groups):
-                sknVtx.boneIndex[vtxIdx] = group.group
-                sknVtx.weights[vtxIdx] = group.weight / weightSum
-
-        #Get UV's
-        if idx in vtxUvs:
-            sknVtx.texcoords[0] = vtxUvs[idx][0]
-            sknVtx.texcoords[1] = vtxUvs[idx][1]
-
-        #writeout the vertex
-        sknVtx.toFile(sknFid)
-    
-    if VERSION >= 2:  # some extra ints in v2+. not sure what they do, non-0 in v4?
-        if header.endTab is None or len(header.endTab) < 3:
-            header.endTab = [0, 0, 0]
-        sknFid.write(struct.pack('<3i', header.endTab[0], header.endTab[1], header.endTab[2]))
-
-    #Close the output file
-    sknFid.close()
+            names.append(material.get('sknName', material.name).encode(
+                    'latin-1', 'replace'))
+    if not names:
+        names.append(defaultName)
+    faceMaterials = np.clip(faceMaterials, 0, len(names) - 1)
+
+    submeshes = buildSubmeshes(indices, vertices, faceMaterials, names,
+            OPTIMIZE)
+    matHeaders, indices, vertices = joinSubmeshes(submeshes)
+    if len(submeshes) > 1:
+        print("Writing %d submeshes" % len(submeshes))
+
+    #override previous #verts, #idxs so no memory error!
+    meta_data.numIndices = len(indices)
+    meta_data.numVertices = len(vertices)
+
+    writeSKN(output_filepath, header, matHeaders, meta_data, indices,
+            vertices, VERSION)
 
 def importSCO(filename):
     '''SCO files contains meshes in plain text'''
@@ -0,0 +1,149 @@
+# ##### BEGIN GPL LICENSE BLOCK ##### #
+# lolblender - Python addon to use League of Legends files into blender
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+"""Skeleton bind poses computed with numpy alone.
+
+Works on the bones returned by lolSkeleton.importSKL, so it runs without
+Blender or mathutils.  Matrices are 4 x 4 affine transforms in Blender's
+axes (z mirrored like the importers do), stacked numBones x 4 x 4.
+"""
+import numpy as np
+from . import lolMath
+
+
+def boneLevels(parents):
+    """Groups bone indices by depth in the hierarchy, roots first.
+    parents holds each bone's parent index, -1 for roots."""
+    parents = np.asarray(parents, dtype=np.intp)
+    depth = np.zeros(len(parents), dtype=np.intp)
+    ancestors = parents.copy()
+    for i in range(len(parents) + 1):
+        inside = ancestors > -1
+        if not inside.any():
+            break
+        depth[inside] += 1
+        ancestors[inside] = parents[ancestors[inside]]
+    else:
+        raise ValueError("SKL bone hierarchy has a cycle")
+    return [np.flatnonzero(depth == d) for d in range(depth.max() + 1)] \
+            if len(depth) else []
+
+
+def affine(rotations, translations):
+    """Stacks 3 x 3 rotations and translations into 4 x 4 matrices"""
+    translations = np.asarray(translations)
+    matrices = np.zeros(translations.shape[:-1] + (4, 4))
+    matrices[..., :3, :3] = rotations
+    matrices[..., :3, 3] = translations
+    matrices[..., 3, 3] = 1
+    return matrices
+
+
+def worldMatrices(local, levels, parents):
+    """Accumulates local matrices down the hierarchy, one batched matrix
+    product per level"""
+    world = np.array(local)
+    for level in levels[1:]:
+        world[level] = np.einsum('nij,njk->nik', world[parents[level]],
+                local[level])
+    return world
+
+
+def localMatrices(world, levels, parents):
+    """Matrices relative to the parent bone, from world matrices"""
+    local = np.array(world)
+    inverse = inverseMatrices(world)
+    for level in levels[1:]:
+        local[level] = np.einsum('nij,njk->nik', inverse[parents[level]],
+                world[level])
+    return local
+
+
+def inverseMatrices(matrices):
+    """Inverts a stack of matrices.  Singular ones (a zero scale bone, for
+    one) get their pseudo-inverse rather than failing the whole skeleton."""
+    try:
+        return np.linalg.inv(matrices)
+    except np.linalg.LinAlgError:
+        print("Singular bone matrices, using pseudo-inverses")
+        return np.array([np.linalg.pinv(m) for m in matrices])
+
+
+class sklPose():
+    """Bind pose of a skeleton.
+
+    parents     numBones        parent index, -1 for roots
+    levels      list            bone indices by depth, roots first
+    local       numBones x 4 x 4    transform relative to the parent
+    world       numBones x 4 x 4    transform in armature space
+    inverseBind numBones x 4 x 4    inverse of world (pseudo-inverse for
+                                    singular bones)
+    """
+
+    def __init__(self, parents, levels, local, world):
+        self.parents = parents
+        self.levels = levels
+        self.local = local
+        self.world = world
+        self.inverseBind = inverseMatrices(world)
+
+    @property
+    def numBones(self):
+        return len(self.parents)
+
+    @property
+    def heads(self):
+        """numBones x 3 world space bone positions"""
+        return self.world[:, :3, 3]
+
+
+def bindPose(boneList, version):
+    """Computes the sklPose of bones read by importSKL from a file of the
+    given version (header.version).  v1-2 files store world matrices, v0
+    files store positions and orientations relative to the parent."""
+    parents, levels, local, world = bindMatrices(boneList, version)
+    if local is None:
+        local = localMatrices(world, levels, parents)
+    return sklPose(parents, levels, local, world)
+
+
+def bindMatrices(boneList, version):
+    """Returns parents, levels, local and world matrices of a bind pose
+    without inverting anything: local is None for v1-2 files, which only
+    store world matrices."""
+    parents = np.array([bone.parent if bone.parent > -1 else -1
+            for bone in boneList], dtype=np.intp)
+    if np.any(parents >= len(boneList)):
+        raise ValueError("SKL bone parent out of range")
+    levels = boneLevels(parents)
+
+    if version in [1, 2]:
+        world = np.zeros((len(boneList), 4, 4))
+        world[:, :3, :] = [bone.matrix for bone in boneList]
+        world[:, 3, 3] = 1
+        local = None
+    elif version == 0:
+        quats = np.array([list(bone.quat) for bone in boneList],
+                dtype=float).reshape(-1, 4)
+        positions = np.array([bone.position for bone in boneList],
+                dtype=float).reshape(-1, 3)
+        local = affine(lolMath.quatToMatrix(quats), positions)
+        world = worldMatrices(local, levels, parents)
+    else:
+        raise ValueError("Version %i not supported" % version)
+    return parents, levels, local, world
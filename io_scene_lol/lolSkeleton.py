@@ -17,7 +17,8 @@
 
 # <pep8 compliant>
 import struct
-import mathutils
+import numpy as np
+from . import lolCache, lolPose
 
 class sklHeader():
     """LoL skeleton header format:
@@ -90,6 +91,55 @@ v0
         sklFile.write(data)
 
 
+#Bone records by skl version, see sklBone
+sklBoneV12Dtype = np.dtype([
+    ('name', 'S32'),
+    ('parent', '<i4'),
+    ('scale', '<f4'),
+    ('matrix', '<f4', (3, 4)),
+])
+sklBoneV0Dtype = np.dtype([
+    ('zero', '<i2'),
+    ('id', '<i2'),
+    ('parent', '<i2'),
+    ('unknown', '<i2'),
+    ('nameHash', '<i4'),
+    ('twoPointOne', '<f4'),
+    ('position', '<f4', 3),
+    ('scale', '<f4', 3),
+    ('orientation', '<f4', 4),
+    ('ct', '<f4', 3),
+    ('extra', '<f4', 8),
+])
+sklBoneDtypes = {0: sklBoneV0Dtype, 1: sklBoneV12Dtype, 2: sklBoneV12Dtype}
+#Bump when importSKL's results change, to invalidate lolCache entries
+sklCacheVersion = 1
+
+
+def readRecords(fid, dtype, count):
+    """Reads count records of dtype in one read"""
+    buf = fid.read(count * dtype.itemsize)
+    if len(buf) < count * dtype.itemsize:
+        raise ValueError("Expected %d records of %d bytes, file has %d" %
+                (count, dtype.itemsize, len(buf) // dtype.itemsize))
+    return np.frombuffer(buf, dtype, count)
+
+
+def readNames(buf, count):
+    """Splits count NUL terminated names, each padded to 4 bytes, off the
+    start of buf"""
+    names = []
+    start = 0
+    for i in range(count):
+        end = buf.find(b'\0', start)
+        if end < 0:
+            raise ValueError("String table ends after %d of %d names" %
+                    (i, count))
+        names.append(buf[start:end].decode())
+        start = (end // 4 + 1) * 4
+    return names
+
+
 class sklBone():
     """LoL Bone structure format
     v1-2
@@ -118,12 +168,11 @@ class sklBone():
     padding?    byte[32]    32      
 
     total                   100
+
+    v0 bones keep the orientation as a (w, x, y, z) tuple in Blender's axes
+    in quat; use mathutils.Quaternion(bone.quat) inside Blender.
     """
     def __init__(self):
-        self.__format__v12 = '<32sif12f'
-        self.__size__v12 = struct.calcsize(self.__format__v12)
-        self.__format__v0 = '<4hi22f'
-        self.__size__v0 = struct.calcsize(self.__format__v0)
         self.name = None
         self.parent = None
         self.scale = None
@@ -132,51 +181,37 @@ class sklBone():
 
     def fromFile(self,sklFile, version):
         """Reads skeleton bone object from a binary file fid"""
+        if version not in sklBoneDtypes:
+            raise ValueError('unhandled version number', version)
+        dtype = sklBoneDtypes[version]
+        self.fromRecord(np.frombuffer(sklFile.read(dtype.itemsize),
+                dtype)[0], version)
+
+    def fromRecord(self, record, version):
+        """Fills the bone from one record of a sklBoneDtypes array"""
         if version in [1,2]:
-            fields = struct.unpack(self.__format__v12, 
-                    sklFile.read(self.__size__v12))
-            self.name = bytes.decode(fields[0]).rstrip('\0')
-            self.parent, self.scale = fields[1:3]
             #Strip null \x00's from the name
-
-            #make z negative
-            self.matrix[0] = list( fields[3:7] )
-            self.matrix[1] = list( fields[7:11] )
-            self.matrix[2] = list( fields[11:15] )
+            self.name = bytes.decode(record['name']).rstrip('\0')
+            self.parent = int(record['parent'])
+            self.scale = float(record['scale'])
 
             #Flip z axis
-            for k in range(4):
-                self.matrix[2][k] = -self.matrix[2][k]
+            matrix = record['matrix'].astype(float)
+            matrix[2] *= -1
+            self.matrix = matrix.tolist()
         elif version == 0:
-            fields = struct.unpack(self.__format__v0,
-                    sklFile.read(self.__size__v0))
-            self.id = fields[1]
-            self.parent = fields[2]
-            self.name = fields[4]
-            twopointone = fields[5]
-            self.position = list(fields[6:9])
+            self.id = int(record['id'])
+            self.parent = int(record['parent'])
+            self.name = int(record['nameHash'])
+            self.position = record['position'].tolist()
             self.position[2] *= -1. # make z negative
-            self.scale = fields[9:12]
-            self.quat = mathutils.Quaternion([
-                    - fields[15], fields[12], fields[13],
-                    - fields[14]])
-            # self.matrix = self.quat.to_matrix()
-            # self.matrix2 = [[],[],[],[]]
-            # for i in range(0,3):
-            #     self.matrix2[i] = [self.matrix[i][0], self.matrix[i][1], 
-            #             self.matrix[i][2], self.position[0]]
-            # self.matrix2[3] = [0, 0, 0, 1]
-            # print(self.matrix)
-            self.ct = list(fields[16:19])
+            self.scale = tuple(record['scale'].tolist())
+            x, y, z, w = record['orientation'].tolist()
+            self.quat = (-w, x, y, -z)
+            self.ct = record['ct'].tolist()
             for i in [1,2]:
                 self.ct[i] *= -1.
-            self.extra = list(fields[19:27])
-            # print("q%s" % self.quat)
-            # print("m%s" % self.matrix)
-            # print("p%s" % self.position)
-            # print("c%s" % self.ct)
-            # sklFile.seek(sklFile.tell()+32)  # skip 32 padding bytes
-
+            self.extra = record['extra'].tolist()
         else:
             raise ValueError('unhandled version number', version)
 
@@ -203,10 +238,92 @@ class sklBone():
         return newBone
 
 
+def elfHash(name):
+    """Hash the game uses to identify bones by name (ELF hash of the
+    lower-cased name), as found in version 4 .anm files"""
+    h = 0
+    for c in name.lower().encode():
+        h = (h << 4) + c
+        high = h & 0xF0000000
+        if high:
+            h ^= high >> 24
+        h &= ~high
+    return h
+
+
+def boneHashDict(names):
+    """Builds a {hash: name} dictionary for bone names, e.g. those of an
+    imported skeleton, to resolve version 4 .anm bones"""
+    return dict((elfHash(name), name) for name in names)
+
+
+def probeSKL(filepath):
+    '''Describes a .skl file from its header alone, without reading the
+    bones.  Returns a dictionary of version, counts, hash and the byte
+    offsets of the bone records and tables.'''
+    header = sklHeader()
+    with open(filepath, 'rb') as sklFid:
+        header.fromFile(sklFid)
+        #the header leaves the file at the bone records
+        info = {
+            'type': 'skl',
+            'version': header.version,
+            'numBones': header.numBones,
+            'boneOffset': sklFid.tell(),
+            }
+        if header.version in [1, 2]:
+            info['skeletonHash'] = header.skeletonHash
+            info['boneSize'] = sklBoneV12Dtype.itemsize
+            info['numBoneIDs'] = 0
+            if header.version == 2:
+                info['boneIDOffset'] = (info['boneOffset'] + 4 +
+                        header.numBones * sklBoneV12Dtype.itemsize)
+                sklFid.seek(info['boneIDOffset'] - 4)
+                buf = sklFid.read(4)
+                if len(buf) == 4:
+                    info['numBoneIDs'] = struct.unpack('<i', buf)[0]
+        elif header.version == 0:
+            info['boneSize'] = sklBoneV0Dtype.itemsize
+            info['numBoneIDs'] = header.numBoneIDs
+            info['boneIDMapOffset'] = header.offset1
+            info['boneIDOffset'] = header.offsetAnimationIndices
+            info['stringOffset'] = header.offsetToStrings
+        else:
+            raise ValueError("Version %i not supported" % header.version)
+        sklFid.seek(0, 2)
+        info['fileSize'] = sklFid.tell()
+    return info
+
+
+def bonesFromRecords(records, version, names=None):
+    '''Builds sklBones from a sklBoneDtypes array.  names replaces the
+    bone names (v0 files keep them in a separate string table).'''
+    boneList = []
+    for record in records:
+        boneList.append(sklBone())
+        boneList[-1].fromRecord(record, version)
+    if names is not None:
+        for bone, name in zip(boneList, names):
+            bone.name = name
+    return boneList
+
+
 def importSKL(filepath):
+    '''Reads a .skl file.  Returns header, boneList, boneIDs where boneIDs
+    (v0 and v2 only, empty otherwise) maps the bone indices used by the
+    .skn vertices to indices into boneList.'''
+    key, cached = lolCache.lookup('skl', filepath, sklCacheVersion)
+    if cached is not None:
+        print("Reading SKL from cache: %s" % filepath)
+        meta, arrays = cached
+        header = lolCache.decodeState(meta['header'], sklHeader())
+        boneList = bonesFromRecords(arrays['records'], header.version,
+                meta['names'])
+        return header, boneList, arrays['boneIDs'].tolist()
+
     header = sklHeader()
-    boneList= []
-    reorderedBoneList = []
+    names = None
+    boneIDs = []
     
     #Wrap open in try block
     sklFid = open(filepath, 'rb')
@@ -215,87 +332,159 @@ def importSKL(filepath):
     header.fromFile(sklFid)
     print("SKL version:%s" % header.version)
     if header.version in [1, 2]:
-        #Read in the bones
-        for k in range(header.numBones):
-            boneList.append(sklBone())
-            boneList[k].fromFile(sklFid, header.version)
-        
-
+        #Read in the bones with a single read
+        records = readRecords(sklFid, sklBoneV12Dtype, header.numBones)
 
         if header.version == 2:  # version 2 has a reordered bone list
             #Read in reordered bone assignments
             numBoneIDs = struct.unpack('<i', sklFid.read(4))[0]  # clue taken from LolViewer
             print ("reordered list size: %i" % numBoneIDs)
-            for i in range(0, numBoneIDs):
-                buf = sklFid.read(4)
-                if buf == b'':
-                    break
-                else:
-                    boneId = struct.unpack('<i', buf)[0]
-                reorderedBoneList.append(boneList[boneId].copy())
+            boneIDs = readRecords(sklFid, np.dtype('<i4'),
+                    numBoneIDs).tolist()
             
     elif header.version == 0:
         # taken from c# code from LoLViewer
-        for k in range(header.numBones):
-            boneList.append(sklBone())
-            boneList[k].fromFile(sklFid, header.version)
+        records = readRecords(sklFid, sklBoneV0Dtype, header.numBones)
         print("(off1) from %s to %s" % (sklFid.tell(), header.offset1))
         sklFid.seek(header.offset1)
-        # indices for version 4 animation
-        header.boneIDMap = {}
-        for i in range(0, header.numBones):
-            # 8 bytes
-            sklID, anmID = struct.unpack('<2i', sklFid.read(
-                    struct.calcsize('<2i')))
-            header.boneIDMap[anmID] = sklID
-
+        # indices for version 4 animation, (sklID, anmID) pairs
+        ids = readRecords(sklFid, np.dtype('<i4'), 2 * header.numBones)
+        header.boneIDMap = dict(zip(ids[1::2].tolist(), ids[0::2].tolist()))
 
+        # NUL terminated names padded to 4 bytes, read in one go up to the
+        # next table (or the end of the file)
         print("(offstr) from %s to %s" % (sklFid.tell(), header.offsetToStrings))
+        tableEnds = [offset for offset in [header.offsetVertexData,
+                header.offset1, header.offsetAnimationIndices]
+                if offset > header.offsetToStrings]
         sklFid.seek(header.offsetToStrings)
-        for i in range(0, header.numBones):
-            name = []
-            while name.count(b'\0') == 0:
-                for j in range(0,4):
-                    name.append(sklFid.read(1))
-            end = name.index(b'\0')
-            boneList[i].name = ''.join(
-                    v.decode() for v in name[0:end])
-            DEBUG_PRINT = False
-            if DEBUG_PRINT and boneList[i].name.lower() in ['root', 'r_weapon', 'shield',
-                    'l_shield', 'r_shield', 'buffbone_cstm_shield_top',
-                    'buffbone_glb_weapon_1', 'l_hip']:
-                bone = boneList[i]
-                print("%s:" % bone.name)
-                print("p:%s" % bone.position)
-                print("ct:%s" % bone.ct)
-                print("q:%s" % bone.quat)
-                if bone.parent > -1:
-                    tct = mathutils.Vector(bone.ct)
-                    tct.rotate(boneList[bone.parent].quat)
-                    print("tct:%s" % tct)
-
-                print("Mags: p:%f, ct:%f" % (mathutils.Vector(
-                        bone.position).length, mathutils.Vector(
-                        bone.ct).length))
-                # print("ex:%s" % boneList[i].extra)
+        if tableEnds:
+            names = readNames(sklFid.read(min(tableEnds) -
+                    header.offsetToStrings), header.numBones)
+        else:
+            names = readNames(sklFid.read(), header.numBones)
 
         # below is technically earlier in file than above
         print("(offani) from %s to %s" % (sklFid.tell(), header.offsetAnimationIndices))
         sklFid.seek(header.offsetAnimationIndices)
-        for i in range(0, header.numBoneIDs):
-            boneId = struct.unpack('<h', sklFid.read(
-                    struct.calcsize('<h')))[0]
-            reorderedBoneList.append(boneList[boneId].copy())
+        boneIDs = readRecords(sklFid, np.dtype('<i2'),
+                header.numBoneIDs).tolist()
         print("end: %s" % sklFid.tell())
     else:
         raise ValueError("Version %i not supported" % header.version)
 
     sklFid.close()
-    return header, boneList, reorderedBoneList
+    boneList = bonesFromRecords(records, header.version, names)
+
+    lolCache.store(key, {'header': lolCache.encodeState(header),
+            'names': names}, {'records': records,
+            'boneIDs': np.array(boneIDs, dtype=np.int32)})
+    return header, boneList, boneIDs
+
+
+
+class sklAsset():
+    '''A .skl file parsed once: header, boneList and boneIDs as returned by
+    importSKL.  obj is the Blender armature built from it, if any.'''
+
+    def __init__(self, filepath, header, boneList, boneIDs):
+        self.filepath = filepath
+        self.header = header
+        self.boneList = boneList
+        self.boneIDs = boneIDs
+        self.obj = None
+
+
+def loadSKL(filepath):
+    '''Reads a .skl file into a sklAsset'''
+    return sklAsset(filepath, *importSKL(filepath))
+
+
+def boneChildren(boneList):
+    """Returns the children of every bone (in bone order) and an order in
+    which every parent comes before its children"""
+    children = [[] for bone in boneList]
+    roots = []
+    for i, bone in enumerate(boneList):
+        if bone.parent > -1:
+            if bone.parent >= len(boneList):
+                raise ValueError("Bone %s has no parent %d" % (bone.name,
+                        bone.parent))
+            children[bone.parent].append(i)
+        else:
+            roots.append(i)
+
+    order = roots
+    for i in order:  # grows while iterating, breadth first
+        order.extend(children[i])
+    if len(order) != len(boneList):
+        raise ValueError("SKL bone hierarchy has a cycle")
+    return children, order
+
 
+def isBuffBone(name):
+    return name.isupper() or 'buffbone' in name.lower()
+
+
+def armatureLayout(boneList, version):
+    """Works out the armature built from boneList without Blender.
+    Returns parents (bone indices, -1 for roots), heads and tails.
+
+    Bones with children point at their first buffbone child, or else at the
+    average of their children's heads.  A leaf spans from its parent's tail
+    to its own head, unless that is exactly where the parent ends, in which
+    case it continues in the parent's direction with length 10.  Root
+    leaves have length 10 and point towards the origin (+y at the origin).
+    """
+    if version not in [0, 1, 2]:
+        raise ValueError("Version %i not supported" % version)
+    children, order = boneChildren(boneList)
+    parents = [bone.parent if bone.parent > -1 else -1 for bone in boneList]
+    #only the world translations are needed, so skip the inversions
+    #bindPose does (a singular bone matrix must not stop the import)
+    world = lolPose.bindMatrices(boneList, version)[3]
+    heads = world[:, :3, 3].astype(np.float32)
+    tails = np.zeros_like(heads)
+    names = [bone.name.rstrip('\x00') for bone in boneList]
+
+    for i in order:
+        parent = parents[i]
+        if children[i]:
+            buff = [c for c in children[i] if isBuffBone(names[c])]
+            if buff:
+                tails[i] = heads[buff[0]]
+            else:
+                weight = np.float32(1.0 / len(children[i]))
+                pos = np.zeros(3, dtype=np.float32)
+                for c in children[i]:
+                    pos += heads[c] * weight
+                tails[i] = pos
+        elif parent > -1:
+            if np.any(tails[parent] != heads[i]):
+                tails[i] = heads[i]
+                heads[i] = tails[parent]
+            else:
+                direction = tails[parent] - heads[parent]
+                length = np.sqrt(np.dot(direction, direction))
+                if length > 0:
+                    tails[i] = heads[i] + direction * (10 / length)
+                else:
+                    tails[i] = heads[i]
+        else:
+            length = np.sqrt(np.dot(heads[i], heads[i]))
+            if length > 0:
+                tails[i] = heads[i] * (1 - 10 / length)
+            else:
+                tails[i] = (0, 10, 0)
+
+        # Blender drops zero length bones
+        if np.all(heads[i] == tails[i]):
+            tails[i, 1] += .001
+    return parents, heads, tails
 
 
 def buildSKL(boneList, version):
+    '''Builds an armature object from importSKL bones and returns it'''
     import bpy
     #Create Blender Armature
     bpy.ops.object.armature_add(location=(0,0,0), enter_editmode=True)
@@ -308,140 +497,16 @@ def buildSKL(boneList, version):
     #import the bones
 
     print(len(boneList))
-    # print("%s, p:%s" % (boneName, boneList[bone.parent].name if bone.parent > -1 else None))
+    parents, heads, tails = armatureLayout(boneList, version)
 
-    if version in [1,2]:
-        for boneID, bone in enumerate(boneList):
-            boneName = bone.name.rstrip('\x00')
-            try:
-                boneHead = (bone.matrix[0][3], bone.matrix[1][3], bone.matrix[2][3])
-            except:
-                print(bone.matrix)
-            boneParentID = bone.parent
-
-            boneAlignToAxis= (bone.matrix[0][2], bone.matrix[1][2],
-                    bone.matrix[2][2])
-
-
-            newBone = arm.edit_bones.new(boneName)
-            #newBone.head[:] = boneTail
-            
-            #If this is a root bone set the y offset to 0 for the head element
-            #if boneParentID == -1:
-            #    newBone.head[:] = (boneHead[0],0,boneHead[2])
-            newBone.head = boneHead
-
-            #If this bone is a child, find the parent's tail and attach this bone's
-            #head to it
-            if boneParentID > -1:
-                boneParentName = boneList[boneParentID].name
-                parentBone = arm.edit_bones[boneParentName]
-                newBone.parent = parentBone
-                #build chains of successively parented bones
-                # if boneParentID == (boneID - 1):
-                if len(parentBone.children) == 1: 
-                    parentBone.tail = newBone.head
-                    # newBone.use_connect = True
-
-
-            # if newBone.length == 0:
-            #     newBone.length = 10
-            if newBone.head == newBone.tail:
-                newBone.tail.y += .001
-
-        #Final loop through bones.  Find bones w/out children & align to parent (for
-        #now
-
-        for bone in arm.edit_bones:
-            if bone.length == 0:
-                bone.length = 1
-            if len(bone.children) == 0:  # bones without children get aligned to parents?
-                bone.length = 10
-                if bone.parent:
-                    if bone.parent.tail != bone.head: # if parent isn't chained
-                                                      # directly to this bone
-                        bone.tail = bone.head         # then this is "end" pos
-                        bone.head = bone.parent.tail
-                    else:
-                        bone.align_orientation(bone.parent)
-            else:   # for bones w/ children, set tail to avg of all direct
-                    # children, or buffbone
-                numChildren = len(bone.children)
-                pos = mathutils.Vector([0,0,0])
-                for child in bone.children:
-                    if (child.name.isupper() or  # if buffbone, set pos to it
-                            child.name.lower().count('buffbone')):
-                        pos = child.head
-                        break
-                    pos += child.head/numChildren
-                bone.tail = pos
-    elif version == 0:
-
-        for boneID, bone in enumerate(boneList):
-            #algorithm here based off of above, and LolViewer code
-            #If this bone is a child, find the parent's tail and attach this bone's
-            #head to it
-            parentPos = mathutils.Vector([0,0,0])
-            boneHead = mathutils.Vector(bone.position)
-
-            boneParentID = bone.parent
-            boneName = bone.name.rstrip('\x00')
-            # debug
-            # if boneName.count("weapon"):
-            #     print("prev: %s" % boneList[boneID-1].name)
-            #     print("%s, id:%s\np:%s\nq:%s\ns:%s" % (bone.name, boneID, bone.position, bone.quat, bone.scale))
-            #     print("c%s" % bone.ct)
-            #     # print("E%s" % bone.extra)
-            newBone = arm.edit_bones.new(boneName)
-            if boneParentID > -1:
-                boneParentName = boneList[boneParentID].name
-                parentBone = arm.edit_bones[boneParentName]
-
-                newBone.parent = parentBone
-                parQuat = boneList[boneParentID].quat
-                boneHead.rotate(parQuat)  # only apply parent rotation to self
-                bone.quat = parQuat * bone.quat  # for children
-
-                # parentPos = mathutils.Vector(boneList[boneParentID].position)
-                parentPos = parentBone.head
-            newBone.head = parentPos + boneHead
-            if newBone.length == 0:
-                newBone.tail[1] += .001
-
-        # set bones with children to be average of the
-        # for boneID, bone in enumerate(boneList):
-        #     numChildren = len(children[boneID]['all'])
-        #     if numChildren > 0:
-        #         pos = mathutils.Vector([0,0,0])
-        #         for b in children[boneID]['all']:
-        #             pos += arm.edit_bones[b].head/numChildren
-        #         arm.edit_bones[bone.name].tail = pos
-
-
-        for bone in arm.edit_bones:
-            if bone.length == 0:
-                bone.length = 1
-            if len(bone.children) == 0:  # bones without children get aligned to parents?
-                bone.length = 10
-                if bone.parent:
-                    if bone.parent.tail != bone.head: # if parent isn't chained
-                                                      # directly to this bone
-                        bone.tail = bone.head         # then this is "end" pos
-                        bone.head = bone.parent.tail
-                    else:
-                        bone.align_orientation(bone.parent)
-            else:   # for bones w/ children, set tail to avg of all direct
-                    # children, or buffbone
-                numChildren = len(bone.children)
-                pos = mathutils.Vector([0,0,0])
-                for child in bone.children:
-                    if (child.name.isupper() or  # if buffbone, set pos to it
-                            child.name.lower().count('buffbone')):
-                        pos = child.head
-                        break
-                    pos += child.head/numChildren
-                bone.tail = pos
+    #Blender may rename duplicate bones, so parents are assigned by handle
+    editBones = [bones.new(bone.name.rstrip('\x00')) for bone in boneList]
+    for editBone, parent, head, tail in zip(editBones, parents,
+            heads.tolist(), tails.tolist()):
+        editBone.head = head
+        editBone.tail = tail
+        if parent > -1:
+            editBone.parent = editBones[parent]
 
     bpy.ops.object.mode_set(mode='OBJECT')
-
-
+    return obj
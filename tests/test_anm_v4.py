@@ -0,0 +1,94 @@
+"""Bulk decoding of version 4 .anm frame data (lolAnimation.readFramesV4)."""
+import os
+import random
+import shutil
+import struct
+import tempfile
+import unittest
+
+import numpy as np
+
+from io_scene_lol import lolAnimation
+
+
+def writeANMV4(filepath, hashes, records, positions, orientations):
+    """Writes a version 4 file; records are (hash, positionId,
+    orientationId) tuples, numBones of them per frame"""
+    positionOffset = 64  # header size after the id/version block
+    orientationOffset = positionOffset + 12 * len(positions)
+    indexOffset = orientationOffset + 16 * len(orientations)
+    with open(filepath, 'wb') as fid:
+        fid.write(struct.pack('<8si', b'r3d2anmd', 4))
+        fid.write(struct.pack('<i3f2if9i', 0, 0, 0, 0, len(hashes),
+                len(records) // len(hashes), 1 / 30.0, 0, 0, 0,
+                positionOffset, orientationOffset, indexOffset, 0, 0, 0))
+        for position in positions:
+            fid.write(struct.pack('<3f', *position))
+        for orientation in orientations:
+            fid.write(struct.pack('<4f', *orientation))
+        for boneHash, positionId, orientationId in records:
+            fid.write(struct.pack('<I4H', boneHash, positionId, 0,
+                    orientationId, 0))
+
+
+class ReadFramesV4Test(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.directory, 'clip.anm')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_frames_by_bone(self):
+        rng = random.Random(4)
+        hashes = [0x0badf00d, 0x12345678, 0xfedcba98]
+        numFrames = 5
+        positions = [[rng.uniform(-1, 1) for i in range(3)]
+                for j in range(6)]
+        orientations = [[rng.uniform(-1, 1) for i in range(4)]
+                for j in range(7)]
+        expected = {}
+        records = []
+        #bones come in a different order in every frame
+        for frame in range(numFrames):
+            for boneHash in rng.sample(hashes, len(hashes)):
+                positionId = rng.randrange(len(positions))
+                orientationId = rng.randrange(len(orientations))
+                records.append((boneHash, positionId, orientationId))
+                expected[boneHash, frame] = (orientations[orientationId] +
+                        positions[positionId])
+        writeANMV4(self.filepath, hashes, records, positions, orientations)
+
+        header = lolAnimation.anmHeader()
+        with open(self.filepath, 'rb') as fid:
+            header.fromFile(fid, verbose=False)
+            foundHashes, frames = lolAnimation.readFramesV4(fid, header)
+
+        #bones are numbered by first appearance
+        firstSeen = []
+        for boneHash, positionId, orientationId in records:
+            if boneHash not in firstSeen:
+                firstSeen.append(boneHash)
+        self.assertEqual(foundHashes.tolist(), firstSeen)
+        self.assertEqual(frames.shape, (numFrames, len(hashes), 7))
+        for bone, boneHash in enumerate(firstSeen):
+            for frame in range(numFrames):
+                np.testing.assert_allclose(frames[frame, bone],
+                        expected[boneHash, frame], rtol=1e-6)
+
+    def test_truncated_frames(self):
+        records = [(1, 0, 0), (2, 0, 0)] * 3
+        writeANMV4(self.filepath, [1, 2], records, [[0, 0, 0]],
+                [[0, 0, 0, 1]])
+        with open(self.filepath, 'r+b') as fid:
+            fid.truncate(os.path.getsize(self.filepath) - 4)
+        header = lolAnimation.anmHeader()
+        with open(self.filepath, 'rb') as fid:
+            header.fromFile(fid, verbose=False)
+            self.assertRaises(ValueError, lolAnimation.readFramesV4, fid,
+                    header)
+
+
+if __name__ == '__main__':
+    unittest.main()
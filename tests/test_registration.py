@@ -0,0 +1,71 @@
+"""Enabling the add-on must not import the file parsers (or numpy).
+
+Runs in a fresh interpreter with minimal stand-ins for the bpy and
+bpy_extras modules, so it works outside of Blender.
+"""
+import os
+import subprocess
+import sys
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCRIPT = r'''
+import sys
+import time
+import types
+
+bpy = types.ModuleType('bpy')
+bpy.props = types.ModuleType('bpy.props')
+for name in ['StringProperty', 'BoolProperty', 'IntProperty',
+        'FloatProperty', 'EnumProperty']:
+    setattr(bpy.props, name, lambda **kwargs: None)
+bpy.types = types.ModuleType('bpy.types')
+bpy.types.Operator = type('Operator', (), {})
+bpy.types.INFO_MT_file_import = []
+bpy.types.INFO_MT_file_export = []
+bpy.utils = types.ModuleType('bpy.utils')
+registered = []
+bpy.utils.register_class = registered.append
+bpy_extras = types.ModuleType('bpy_extras')
+bpy_extras.io_utils = types.ModuleType('bpy_extras.io_utils')
+bpy_extras.io_utils.ImportHelper = type('ImportHelper', (), {})
+bpy_extras.io_utils.ExportHelper = type('ExportHelper', (), {})
+sys.modules.update({'bpy': bpy, 'bpy.props': bpy.props,
+        'bpy.types': bpy.types, 'bpy.utils': bpy.utils,
+        'bpy_extras': bpy_extras, 'bpy_extras.io_utils': bpy_extras.io_utils})
+
+start = time.time()
+import io_scene_lol
+assert io_scene_lol.__in_blender__
+assert 'io_scene_lol.__bpy_init__' not in sys.modules
+io_scene_lol.register()
+elapsed = time.time() - start
+
+assert len(registered) == 4, registered
+assert len(bpy.types.INFO_MT_file_import) == 1
+assert len(bpy.types.INFO_MT_file_export) == 1
+for name in ['numpy', 'io_scene_lol.lolMesh', 'io_scene_lol.lolSkeleton',
+        'io_scene_lol.lolAnimation', 'io_scene_lol.lolCache']:
+    assert name not in sys.modules, name + ' imported by register()'
+for name in ['import_char', 'import_animation', 'export_char',
+        'import_sco']:
+    assert callable(getattr(io_scene_lol, name)), name
+print(elapsed)
+'''
+
+
+class RegistrationTest(unittest.TestCase):
+
+    def test_register_skips_parsers(self):
+        result = subprocess.run([sys.executable, '-c', SCRIPT],
+                cwd=REPO_DIR, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        #import and register take a few milliseconds; importing numpy
+        #alone takes about 0.1 s
+        self.assertLess(float(result.stdout.split()[-1]), 0.05)
+
+
+if __name__ == '__main__':
+    unittest.main()
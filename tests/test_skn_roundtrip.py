@@ -0,0 +1,100 @@
+"""Meshes with more than 65535 vertices survive a write and read.
+
+Such files store each material's indices relative to its startVertex
+(see lolMesh.joinSubmeshes and lolMesh.absoluteIndices).
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from io_scene_lol import lolCache, lolMesh
+
+
+def gridMesh(size):
+    """A size x size vertex grid; every vertex has a distinct position"""
+    vertices = np.zeros(size * size, dtype=lolMesh.sknVertexDtype)
+    rows, cols = np.divmod(np.arange(size * size), size)
+    vertices['position'][:, 0] = cols
+    vertices['position'][:, 1] = rows
+    vertices['weights'][:, 0] = 1
+    corner = (np.arange(size - 1)[:, None] * size +
+            np.arange(size - 1)).ravel()
+    triangles = np.concatenate([
+            np.column_stack([corner, corner + 1, corner + size]),
+            np.column_stack([corner + 1, corner + size + 1, corner + size])])
+    return triangles, vertices
+
+
+def triangleSet(triangles, vertices, size):
+    """Triangles as grid vertex numbers, rotated to start at the smallest
+    so the winding is kept but the starting corner does not matter"""
+    position = vertices['position'][np.asarray(triangles)]
+    grid = (position[..., 1] * size + position[..., 0]).astype(np.int64)
+    start = np.argmin(grid, axis=1)
+    rotated = grid[np.arange(len(grid))[:, None],
+            (start[:, None] + np.arange(3)) % 3]
+    return set(map(tuple, rotated.tolist()))
+
+
+class LargeMeshRoundTripTest(unittest.TestCase):
+
+    def setUp(self):
+        lolCache.configure(None)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_relative_indices_round_trip(self):
+        size = 300
+        triangles, vertices = gridMesh(size)
+        #most of the grid in one material, so it has to be partitioned too
+        column = vertices['position'][triangles[:, 0], 0]
+        faceMaterials = (column >= 250).astype(np.int32)
+        names = [b'left', b'right']
+
+        submeshes = lolMesh.buildSubmeshes(triangles.ravel(), vertices,
+                faceMaterials, names, optimize=False)
+        materials, indices, outVertices = lolMesh.joinSubmeshes(submeshes)
+        self.assertGreater(len(outVertices), lolMesh.sknMaxVertices)
+
+        header = lolMesh.sknHeader()
+        header.magic = 1122867
+        header.version = 1
+        header.numObjects = 1
+        metaData = lolMesh.sknMetaData(0, len(indices), len(outVertices))
+        filepath = os.path.join(self.directory, 'grid.skn')
+        lolMesh.writeSKN(filepath, header, materials, metaData, indices,
+                outVertices, 1)
+
+        header, readMaterials, metaData, readIndices, readVertices = \
+                lolMesh.importSKNArrays(filepath)
+        self.assertEqual(len(readVertices), len(outVertices))
+        self.assertEqual(len(readIndices), len(triangles) * 3)
+        readTriangles = np.asarray(readIndices).reshape(-1, 3)
+        self.assertEqual(triangleSet(readTriangles, readVertices, size),
+                triangleSet(triangles, vertices, size))
+
+        #each material still covers exactly its own triangles
+        for slot, name in enumerate(names):
+            expected = triangleSet(triangles[faceMaterials == slot],
+                    vertices, size)
+            found = set()
+            for mat in readMaterials:
+                if lolMesh.sknMaterialName(mat) != name.decode():
+                    continue
+                matIndices = readIndices[mat.startIndex:
+                        mat.startIndex + mat.numIndices]
+                self.assertTrue(np.all(matIndices >= mat.startVertex))
+                self.assertTrue(np.all(matIndices <
+                        mat.startVertex + mat.numVertices))
+                found |= triangleSet(np.reshape(matIndices, (-1, 3)),
+                        readVertices, size)
+            self.assertEqual(found, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()